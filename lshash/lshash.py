@@ -6,9 +6,17 @@
 
 import sys
 
+from collections import deque
+from contextlib import contextmanager
 from copy import deepcopy
+from functools import wraps
+from operator import itemgetter
+import hashlib
+import heapq
 import os
 import json
+import threading
+import time
 
 
 def _is_setup_mode():
@@ -22,12 +30,115 @@ if _is_setup_mode:
 else:
     import numpy as np
 
-from .storage import storage, Levels
+from .storage import storage, BinaryCodec, Levels, ShardedStorage, _as_value, _import_optional
 
-try:
-    from bitarray import bitarray
-except ImportError:
-    bitarray = None
+
+class _ReadWriteLock(object):
+    """ A lock held either by any number of readers, or by a single writer. """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    @contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writing:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._condition:
+            while self._writing:
+                self._condition.wait()
+            # the new readers wait for the writer
+            self._writing = True
+            while self._readers:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+def _reading_tables(method):
+    """ Runs `method` with the hash tables, which :meth:`LSHash.rebuild` can
+    swap, held for reading. """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._tables_lock.reading():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class Rebuild(object):
+    """ An online rebuild of the hash tables of an :class:`LSHash`, returned
+    by :meth:`LSHash.rebuild`.
+
+    `indexed` is the number of points indexed in the new hash tables so far,
+    and `done` whether the rebuild is over, the new hash tables being swapped
+    in unless it failed with `error`.
+    """
+
+    def __init__(self, lsh, target, batch_size, throttle):
+        self.lsh = lsh
+        self.target = target
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.indexed = 0
+        self.done = False
+        self.error = None
+        self._thread = None
+
+    def start(self, background=True):
+        if not background:
+            self.run()
+            return self
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self):
+        try:
+            batch = 0
+            for record in self.lsh._scan_records():
+                point, extra_data = record if self.lsh._has_extra(record) else (record, None)
+                self.target.index(list(point), extra_data)
+                self.indexed += 1
+                batch += 1
+                if batch == self.batch_size:
+                    batch = 0
+                    # leave room for the live queries
+                    time.sleep(self.throttle)
+            self.lsh._swap_tables(self.target)
+        except Exception as e:
+            self.error = e
+            self.lsh._rebuild = None
+            if self._thread is None:
+                raise
+        finally:
+            self.done = True
+
+    def wait(self, timeout=None):
+        """ Waits for the end of the rebuild, raising its error if it failed.
+        Returns whether the rebuild is over. """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.done
 
 
 class LSHash(object):
@@ -50,20 +161,38 @@ class LSHash(object):
         configuration used by the backend. For `redis` it should be in the
         format of `{"redis": {"host": hostname, "port": port_num}}`, where
         `hostname` is normally `localhost` and `port` is normally 6379.
+        For `sharded` it should be in the format of
+        `{"sharded": {"shards": [config1, config2, ...], "placement": placement}}`
+        where each shard config is itself a `{backend_name: config}` dictionary.
     :param matrices_filename:
         (optional) Specify the path to the compressed numpy file ending with
         extension `.npz`, where the uniform random planes are stored, or to be
         stored if the file does not exist yet.
     :param overwrite:
         (optional) Whether to overwrite the matrices file if it already exist
+    :param storage_layout:
+        (optional) Either `inline` or `ids`. With `inline`, the hash tables
+        hold the indexed points and their extra data. With `ids`, each point
+        and its extra data is stored once as a record of the storage of the
+        first hash table, and the hash tables only hold the id of the record.
+        The records of the candidates of a query are fetched in one batch.
+        By default `inline` is used.
+    :param table_offset:
+        (optional) The index in the storage of the first hash table, the next
+        ones following it. The hash tables built by :meth:`rebuild` are stored
+        after the previous ones. It is saved to the matrices file, and
+        restored from it along with the hash size and the number of hash
+        tables, the ones of the planes of the file. By default 0 is used.
     """
 
     def __init__(self, hash_size, input_dim, num_hashtables=1,
-                 storage_config=None, matrices_filename=None, overwrite=False):
+                 storage_config=None, matrices_filename=None, overwrite=False,
+                 storage_layout="inline", table_offset=0):
 
         self.hash_size = hash_size
         self.input_dim = input_dim
         self.num_hashtables = num_hashtables
+        self.table_offset = table_offset
 
         if storage_config is None:
             storage_config = {'dict': None}
@@ -74,6 +203,16 @@ class LSHash(object):
         self.matrices_filename = matrices_filename
         self.overwrite = overwrite
 
+        if storage_layout not in ("inline", "ids"):
+            raise ValueError("The storage layout should be either 'inline' or 'ids'.")
+        self.storage_layout = storage_layout
+
+        # held for reading by the index and query operations, and for writing
+        # to swap the hash tables built by a rebuild
+        self._tables_lock = _ReadWriteLock()
+        # the rebuild in progress, see :meth:`rebuild`
+        self._rebuild = None
+
         self._init_uniform_planes()
         self._init_hashtables()
 
@@ -93,6 +232,9 @@ class LSHash(object):
         if "uniform_planes" in self.__dict__:
             return
 
+        # extra planes used to split the overfull buckets, by hash table index
+        self.split_planes = {}
+
         if self.matrices_filename:
             file_exist = os.path.isfile(self.matrices_filename)
             if file_exist and not self.overwrite:
@@ -102,27 +244,48 @@ class LSHash(object):
                     print("Cannot load specified file as a numpy array")
                     raise
                 else:
-                    npzfiles = sorted(npzfiles.items(), key=lambda x: x[0])
-                    self.uniform_planes = [t[1] for t in npzfiles]
+                    # arrays saved as positional arguments are named `arr_<index>`
+                    planes = sorted((int(name[4:]), array) for name, array in npzfiles.items()
+                                    if name.startswith("arr_"))
+                    self.uniform_planes = [t[1] for t in planes]
+                    self.split_planes = {int(name[6:]): array for name, array in npzfiles.items()
+                                         if name.startswith("split_")}
+                    if "table_offset" in npzfiles:
+                        # the configuration of the hash tables, which a
+                        # rebuild may have changed, is the one of the file
+                        self.table_offset = int(npzfiles["table_offset"])
+                        self.num_hashtables = len(self.uniform_planes)
+                        self.hash_size = self.uniform_planes[0].shape[0]
             else:
                 self.uniform_planes = [self._generate_uniform_planes()
                                        for _ in range(self.num_hashtables)]
-                try:
-                    np.savez_compressed(self.matrices_filename,
-                                        *self.uniform_planes)
-                except IOError:
-                    print("IOError when saving matrices to specificed path")
-                    raise
+                self._save_matrices()
         else:
             self.uniform_planes = [self._generate_uniform_planes()
                                    for _ in range(self.num_hashtables)]
 
+    def _save_matrices(self):
+        """ Save the uniform planes, and the split planes, to the file
+        `self.matrices_filename` if it is set. """
+
+        if not self.matrices_filename:
+            return
+        split_planes = {f"split_{i}": planes for i, planes in self.split_planes.items()}
+        try:
+            np.savez_compressed(self.matrices_filename, *self.uniform_planes,
+                                table_offset=np.array(self.table_offset), **split_planes)
+        except IOError:
+            print("IOError when saving matrices to specificed path")
+            raise
+
     def _init_hashtables(self):
         """ Initialize the hash tables such that each record will be in the
         form of "[storage1, storage2, ...]" """
 
-        self.hash_tables = [storage(self.storage_config, i)
+        self.hash_tables = [storage(self.storage_config, self.table_offset + i)
                             for i in range(self.num_hashtables)]
+        # the storage holding the records of the `ids` storage layout
+        self.record_store = self.hash_tables[0] if self.storage_layout == "ids" else None
 
     def _generate_uniform_planes(self):
         """ Generate uniformly distributed hyperplanes and return it as a 2D
@@ -131,12 +294,83 @@ class LSHash(object):
 
         return np.random.randn(self.hash_size, self.input_dim)
 
+    def fit(self, sample, method="itq", n_iter=50):
+        """ Learns the planes of the hash tables from `sample`, a matrix of
+        points representative of the points to index, one per row. The planes
+        replace the random uniform ones and are saved to `matrices_filename`.
+
+        The learned planes have an offset, stored as an extra last column, so
+        that each bit splits the sample evenly. This gives more even bucket
+        sizes than the random planes for the same `hash_size`.
+
+        :param sample:
+            A 2D array-like of points of dimension `input_dim`.
+        :param method:
+            (optional) The way the planes are learned, one of:
+            "itq": the principal directions of the sample, rotated by an
+            iterative quantization to minimize the quantization error.
+            "pca": the principal directions of the sample, randomly rotated to
+            balance their variances.
+            "median": random uniform planes, offset to the median projection of
+            the sample.
+            The principal directions need `hash_size` to be at most
+            `input_dim`. Each hash table gets its own random rotation, and for
+            "itq" its own bootstrap of the sample. By default "itq" is used.
+        :param n_iter:
+            (optional) The number of iterations of the "itq" method.
+        """
+
+        if any(table.keys() for table in self.hash_tables):
+            raise ValueError("The planes need to be fitted before indexing points, "
+                             "or given a `sample` to rebuild.")
+        if method not in ("itq", "pca", "median"):
+            raise ValueError("The method should be one of 'itq', 'pca' or 'median'.")
+        sample = np.asarray(sample, dtype=float)
+        if sample.ndim != 2 or sample.shape[1] != self.input_dim or len(sample) < 2:
+            raise ValueError("The sample should be a matrix of at least 2 points of dimension `input_dim`.")
+        if method != "median" and self.hash_size > self.input_dim:
+            raise ValueError("The 'itq' and 'pca' methods need `hash_size` to be at most `input_dim`.")
+
+        uniform_planes = []
+        for i in range(self.num_hashtables):
+            if method == "median":
+                planes = self._generate_uniform_planes()
+            else:
+                if method == "itq" and self.num_hashtables > 1:
+                    table_sample = sample[np.random.randint(len(sample), size=len(sample))]
+                else:
+                    table_sample = sample
+                planes = self._fit_principal_planes(table_sample, method, n_iter)
+            offsets = -np.median(sample.dot(planes.T), axis=0)
+            uniform_planes.append(np.hstack([planes, offsets[:, np.newaxis]]))
+        self.uniform_planes = uniform_planes
+        self._save_matrices()
+
+    def _fit_principal_planes(self, sample, method, n_iter):
+        """ Returns the `hash_size` principal directions of `sample`, rotated
+        randomly, and by iterative quantization for the "itq" `method`. """
+
+        centred = sample - sample.mean(axis=0)
+        # the principal directions are the top right singular vectors
+        _, _, vh = np.linalg.svd(centred, full_matrices=False)
+        directions = vh[:self.hash_size].T
+        # a random orthogonal matrix
+        rotation, _ = np.linalg.qr(np.random.randn(self.hash_size, self.hash_size))
+        if method == "itq":
+            projected = centred.dot(directions)
+            for _ in range(n_iter):
+                codes = np.where(projected.dot(rotation) >= 0, 1., -1.)
+                u, _, vh = np.linalg.svd(codes.T.dot(projected))
+                rotation = vh.T.dot(u.T)
+        return directions.dot(rotation).T
+
     def _hash(self, planes, input_point):
         """ Generates the binary hash for `input_point` and returns it.
 
         :param planes:
             The planes are random uniform planes with a dimension of
-            `hash_size` * `input_dim`.
+            `hash_size` * `input_dim`, or planes learned by :meth:`fit`, with an
+            extra last column holding their offsets.
         :param input_point:
             A Python tuple or list object that contains only numbers.
             The dimension needs to be 1 * `input_dim`.
@@ -144,7 +378,10 @@ class LSHash(object):
 
         try:
             input_point = np.array(input_point)  # for faster dot product
-            projections = np.dot(planes, input_point)
+            if planes.shape[1] == self.input_dim + 1:
+                projections = np.dot(planes[:, :-1], input_point) + planes[:, -1]
+            else:
+                projections = np.dot(planes, input_point)
         except TypeError as e:
             print("""The input point needs to be an array-like object with
                   numbers only elements""")
@@ -156,6 +393,70 @@ class LSHash(object):
         else:
             return "".join(['1' if i > 0 else '0' for i in projections.flat])
 
+    def _bucket_key(self, i, input_point):
+        """ Returns the key of the bucket of the `i`-th hash table where
+        `input_point` is stored.
+
+        This is the binary hash of `input_point`, extended with one extra bit
+        for each split of the bucket.
+        """
+
+        table = self.hash_tables[i]
+        key = self._hash(self.uniform_planes[i], input_point)
+        while table.is_split(key):
+            depth = len(key) - self.hash_size
+            key += self._hash(self._get_split_planes(i, table)[depth:depth + 1], input_point)
+        return key
+
+    def _get_split_planes(self, i, table):
+        """ Returns the planes used to split the buckets of the `i`-th hash
+        table, generating them on first use. """
+
+        if i not in self.split_planes:
+            self.split_planes[i] = np.random.randn(table.max_split_bits, self.input_dim)
+            self._save_matrices()
+        return self.split_planes[i]
+
+    def _split_bucket(self, i, key):
+        """ Split the overfull bucket stored at `key` in the `i`-th hash table
+        by moving its values to two buckets keyed with one more hash bit. """
+
+        table = self.hash_tables[i]
+        depth = len(key) - self.hash_size
+        if depth >= table.max_split_bits:
+            return
+        planes = self._get_split_planes(i, table)[depth:depth + 1]
+        values = table.pop_list(key)
+        table.mark_split(key)
+        children = set()
+        for value, record in zip(values, self._records(values)):
+            if record is None:
+                continue
+            child = key + self._hash(planes, self._as_np_array(record))
+            table.append_val(child, value)
+            children.add(child)
+        for child in children:
+            if table.is_overfull(child):
+                self._split_bucket(i, child)
+
+    def _record_id(self, value):
+        """ Returns the id of the record of `value` for the `ids` storage
+        layout, derived from its content so that a point indexed several
+        times has a single record. """
+        return hashlib.sha1(repr(value).encode()).hexdigest()
+
+    def _records(self, values):
+        """ Returns the records of the `values` stored in the hash tables,
+        fetched in one batch for the `ids` storage layout. None is returned
+        for the missing records. """
+        if self.record_store is None:
+            return list(values)
+        return self.record_store.get_records(list(values))
+
+    def _resolve(self, values):
+        """ Like :meth:`_records`, without the missing records. """
+        return [record for record in self._records(values) if record is not None]
+
     def _as_np_array(self, json_or_tuple):
         """ Takes either a JSON-serialized data structure or a tuple that has
         the original input points stored, and returns the original input point
@@ -188,6 +489,7 @@ class LSHash(object):
         else:
             raise TypeError("query data is not supported")
 
+    @_reading_tables
     def index(self, input_point, extra_data=None):
         """ Index a single input point by adding it to the selected storage.
 
@@ -214,13 +516,26 @@ class LSHash(object):
         else:
             value = tuple(input_point)
 
+        if self.record_store is not None:
+            record_id = self._record_id(value)
+            self.record_store.set_records({record_id: value})
+            value = record_id
+
         index_keys = []
         for i, table in enumerate(self.hash_tables):
-            k = self._hash(self.uniform_planes[i], input_point)
+            k = self._bucket_key(i, input_point)
             table.append_val(k, value)
+            if table.is_overfull(k):
+                self._split_bucket(i, k)
+                k = self._bucket_key(i, input_point)
             index_keys.append(k)
+        rebuild = self._rebuild
+        if rebuild is not None:
+            # the point is indexed in the hash tables being rebuilt too
+            rebuild.target.index(input_point, extra_data)
         return index_keys
     
+    @_reading_tables
     def hash(self, input_point):
         """ Index a single input point by adding it to the selected storage.
 
@@ -241,11 +556,125 @@ class LSHash(object):
 
         index_keys = []
         for i, table in enumerate(self.hash_tables):
-            k = self._hash(self.uniform_planes[i], input_point)
+            k = self._bucket_key(i, input_point)
             index_keys.append(k)
         return index_keys
 
-    def query(self, query_point, num_results=None, distance_func=None, level=None):
+    def rebuild(self, hash_size=None, num_hashtables=None, uniform_planes=None,
+                sample=None, method="itq", background=True, batch_size=1000,
+                throttle=0.01, table_offset=None):
+        """ Builds new hash tables from the points already indexed, and swaps
+        them in once they are complete, e.g. to add hash tables or to change
+        `hash_size`. Returns the :class:`Rebuild` in progress.
+
+        The new hash tables are stored after the current ones. Until the swap
+        the current hash tables serve the queries, and the points indexed
+        meanwhile are indexed in both. The current hash tables are left in the
+        storage after the swap.
+
+        :param hash_size:
+            (optional) The hash size of the new hash tables. By default the
+            current one is used.
+        :param num_hashtables:
+            (optional) The number of new hash tables. By default the current
+            one is used.
+        :param uniform_planes:
+            (optional) The list of the planes of the new hash tables. By
+            default random uniform planes are generated.
+        :param sample:
+            (optional) A sample of points to learn the planes of the new hash
+            tables from, see :meth:`fit`, with the given `method`.
+        :param background:
+            (optional) Whether to rebuild in a background thread, or before
+            returning. By default a background thread is used.
+        :param batch_size:
+            (optional) The number of points indexed between two pauses of
+            `throttle` seconds, which leave room for the live queries.
+        :param table_offset:
+            (optional) The index in the storage of the first new hash table,
+            by default the one following the current hash tables. The new hash
+            tables need to be empty.
+        """
+
+        if self._rebuild is not None:
+            raise ValueError("A rebuild is already in progress.")
+        if uniform_planes is not None:
+            num_hashtables = len(uniform_planes)
+            hash_size = uniform_planes[0].shape[0]
+        if table_offset is None:
+            table_offset = self.table_offset + self.num_hashtables
+        target = LSHash(hash_size or self.hash_size, self.input_dim,
+                        num_hashtables or self.num_hashtables, self.storage_config,
+                        storage_layout=self.storage_layout, table_offset=table_offset)
+        if any(table.keys() for table in target.hash_tables):
+            raise ValueError("The new hash tables need to be empty, set another `table_offset`.")
+        if uniform_planes is not None:
+            target.uniform_planes = list(uniform_planes)
+        elif sample is not None:
+            target.fit(sample, method)
+
+        rebuild = Rebuild(self, target, batch_size, throttle)
+        # the points indexed from now on are indexed in the new hash tables too
+        with self._tables_lock.writing():
+            self._rebuild = rebuild
+        return rebuild.start(background)
+
+    def _scan_records(self):
+        """ Yields the records of the indexed points, each one once. """
+
+        # a point may have been left out of some hash tables by a bucket limit
+        tables = list(self.hash_tables)
+        seen = set()
+        for table in tables:
+            # the keys of the in-memory storage are a view of the live buckets
+            for key in list(table.keys()):
+                values = [value for value in table.get_list(key) if value not in seen]
+                seen.update(values)
+                for record in self._records(values):
+                    if record is not None:
+                        yield record
+
+    @staticmethod
+    def _has_extra(record):
+        """ Returns whether `record` is a `(point, extra_data)` pair. """
+        return len(record) == 2 and isinstance(record[0], (tuple, list))
+
+    def _swap_tables(self, target):
+        """ Swaps in the hash tables rebuilt in `target`. """
+
+        with self._tables_lock.writing():
+            self.hash_size = target.hash_size
+            self.num_hashtables = target.num_hashtables
+            self.table_offset = target.table_offset
+            self.uniform_planes = target.uniform_planes
+            self.split_planes = target.split_planes
+            self.hash_tables = target.hash_tables
+            self.record_store = target.record_store
+            self._rebuild = None
+            self._save_matrices()
+
+    @_reading_tables
+    def flush(self):
+        """ Writes the buffered values of the hash tables to their storages,
+        e.g. before handing a ``segment`` index over to another process. """
+
+        for table in self.hash_tables:
+            table.flush()
+
+    def close(self):
+        """ Waits for a running rebuild, then flushes and closes the storages of
+        the hash tables. The index is not usable anymore. """
+
+        rebuild = self._rebuild
+        if rebuild is not None:
+            rebuild.wait()
+        with self._tables_lock.writing():
+            for table in self.hash_tables:
+                table.close()
+
+    @_reading_tables
+    def query(self, query_point, num_results=None, distance_func=None, level=None,
+              candidate_budget=None):
         """ Takes `query_point` which is either a tuple or a list of numbers,
         returns `num_results` of results as a list of tuples that are ranked
         based on the supplied metric function `distance_func`.
@@ -266,55 +695,417 @@ class LSHash(object):
         :param level:
             (optional) The level to use for multilevel storages. Should be a
             field of `storage.Levels`
+        :param candidate_budget:
+            (optional) Integer, the max amount of candidates fetched from the
+            storage and ranked. It is spread evenly over the hash tables, the
+            part not used by a hash table is left to the next ones. This bounds
+            the cost of a query hitting very large buckets.
         """
 
         candidates = set()
+        # partially ranked candidates, as returned by the shards of a sharded storage
+        ranked = {}
+        budget = candidate_budget
+        d_func = self._get_distance_func(distance_func, query_point)
+        # binary values are ranked without decoding them one by one
+        codec = self._raw_codec()
+
+        for i, table in enumerate(self.hash_tables):
+            limit = self._table_budget(budget, i)
+            for key in self._query_keys(i, query_point, distance_func):
+                if limit == 0:
+                    break
+                if num_results and isinstance(table, ShardedStorage):
+                    # each shard ranks its own part of the bucket, only the
+                    # partial top-k results are merged
+                    shards = table.target_shards(key)
+                    if limit is None:
+                        shard_limits = [None] * len(shards)
+                    else:
+                        shard_limits = table.shard_limits(limit, len(shards))
+
+                    def rank_shard(item, key=key):
+                        """ Returns the number of values fetched from the
+                        shard, and their best ones. """
+                        shard, shard_limit = item
+                        values = self._get_list(shard, key, level, shard_limit, raw=bool(codec))
+                        return len(values), self._rank(self._resolve(values), d_func, num_results, codec)
+                    spent = 0
+                    for fetched, partial in table.scatter(rank_shard, list(zip(shards, shard_limits))):
+                        ranked.update(partial)
+                        spent += fetched
+                else:
+                    values = self._get_list(table, key, level, limit, raw=bool(codec))
+                    candidates.update(values)
+                    spent = len(values)
+                if limit is not None:
+                    limit -= spent
+                    budget -= spent
+
+        # rank candidates by distance function
+        if codec:
+            # the best candidates not ranked by the shards are among the
+            # `num_results` best ones
+            candidates = [(ix, distance) for ix, distance
+                          in self._rank(candidates, d_func, num_results, codec)
+                          if ix not in ranked]
+        else:
+            candidates = set(self._resolve(candidates)).difference(ranked)
+            candidates = self._rank(candidates, d_func)
+        if ranked:
+            candidates.extend(ranked.items())
+            candidates.sort(key=itemgetter(1))
+
+        return candidates[:num_results] if num_results else candidates
+
+    def query_iter(self, query_point, num_results=None, distance_func=None,
+                   max_distance=None, level=None):
+        """ Like :meth:`query`, but returns a generator of the `(candidate,
+        distance)` pairs, in increasing distance order.
+
+        The hash tables are processed one at a time, and the remaining ones
+        are skipped as soon as `num_results` candidates within `max_distance`
+        are found. Only the best `num_results` candidates are kept in a
+        bounded heap, and they are only sorted as they are consumed.
+
+        :param max_distance:
+            (optional) Only the candidates at a distance lower or equal to
+            `max_distance` are returned. The distance is the one computed by
+            `distance_func`, e.g. the squared distance for "euclidean".
+        """
+
+        d_func = self._get_distance_func(distance_func, query_point)
+        # the hash tables are held until the candidates are ranked
+        with self._tables_lock.reading():
+            codec = self._raw_codec()
+            seen = set()
+            # a max-heap of the best candidates if `num_results` is set, a
+            # min-heap of all the candidates otherwise. The counter breaks the
+            # ties.
+            heap = []
+            counter = 0
+            for i, table in enumerate(self.hash_tables):
+                values = []
+                for key in self._query_keys(i, query_point, distance_func):
+                    values.extend(ix for ix in self._get_list(table, key, level, raw=bool(codec))
+                                  if ix not in seen)
+                values = list(dict.fromkeys(values))
+                seen.update(values)
+                if not codec:
+                    # the records of the candidates of the table are fetched in
+                    # one batch, the binary values are decoded when returned
+                    values = self._resolve(values)
+                distances = d_func(*self._candidate_matrix(values, codec))
+                for ix, distance in zip(values, distances):
+                    if max_distance is not None and distance > max_distance:
+                        continue
+                    counter += 1
+                    if not num_results:
+                        heap.append((distance, counter, ix))
+                    elif len(heap) < num_results:
+                        heapq.heappush(heap, (-distance, counter, ix))
+                    elif -heap[0][0] > distance:
+                        heapq.heapreplace(heap, (-distance, counter, ix))
+                if num_results and len(heap) >= num_results:
+                    break
+
+        if num_results:
+            heap = [(-distance, count, ix) for distance, count, ix in heap]
+        heapq.heapify(heap)
+        returned = set()
+        while heap:
+            distance, _, ix = heapq.heappop(heap)
+            if codec:
+                ix = _as_value(codec.loads(ix))
+                # the same value may be stored in both formats while migrating
+                if ix in returned:
+                    continue
+                returned.add(ix)
+            yield ix, distance
+
+    def query_radius(self, query_point, radius, distance_func=None, level=None):
+        """ Returns all the `(candidate, distance)` pairs with a distance to
+        `query_point` lower or equal to `radius`, ranked by distance. Only
+        these candidates are sorted.
+
+        The distance is the one computed by `distance_func`, e.g. the squared
+        distance for "euclidean".
+        """
+
+        return list(self.query_iter(query_point, distance_func=distance_func,
+                                    max_distance=radius, level=level))
+
+    def all_pairs(self, threshold, distance_func=None, level=None, workers=None):
+        """ Returns a generator of the `(point, other_point, distance)` pairs
+        of indexed points sharing a bucket in at least one hash table, with a
+        distance lower or equal to `threshold`, e.g. to find the near-duplicate
+        points of the index.
+
+        The buckets of the hash tables are walked one by one and the pairwise
+        distances of their points computed at once, instead of querying each
+        indexed point. A pair sharing a bucket in several hash tables is only
+        returned once.
+
+        :param threshold:
+            The max distance of the returned pairs. The distance is the one
+            computed by `distance_func`, e.g. the squared distance for
+            "euclidean".
+        :param distance_func:
+            (optional) The distance function to be used, see :meth:`query`.
+        :param level:
+            (optional) The level to use for multilevel storages.
+        :param workers:
+            (optional) Integer, the number of threads computing the distances
+            of the buckets in parallel. The buckets are read from the storage
+            by the calling thread.
+        """
+
+        # the hash tables are taken at once, the ones swapped in by a rebuild
+        # meanwhile are not used
+        with self._tables_lock.reading():
+            tables, record_store = list(self.hash_tables), self.record_store
+        seen = set()
+        dedup = len(tables) > 1
+        for (values, records), pairs in self._map_buckets(
+                lambda bucket: self._bucket_pairs(bucket[1], threshold, distance_func),
+                self._buckets(tables, record_store, level), workers):
+            for i, j, distance in pairs:
+                if dedup:
+                    # the pairs of the previous hash tables are remembered by
+                    # their stored values, i.e. by id for the "ids" layout
+                    pair = frozenset((values[i], values[j]))
+                    if pair in seen:
+                        continue
+                    seen.add(pair)
+                yield records[i], records[j], distance
+
+    @staticmethod
+    def _buckets(tables, record_store, level=None):
+        """ Yields the `(values, records)` of the buckets of the hash `tables`
+        holding at least two points, the records of the `ids` storage layout
+        being read from `record_store`. """
+        for table in tables:
+            for key in table.keys(level=level):
+                values = list(dict.fromkeys(table.get_list(key, level)))
+                if len(values) < 2:
+                    continue
+                records = values if record_store is None else record_store.get_records(values)
+                bucket = [(value, record) for value, record in zip(values, records)
+                          if record is not None]
+                if len(bucket) > 1:
+                    yield tuple(zip(*bucket))
+
+    def _bucket_pairs(self, records, threshold, distance_func):
+        """ Returns the `(i, j, distance)` of the pairs of `records`, with
+        `i < j`, at a distance lower or equal to `threshold`.
+
+        The distances of all the pairs are computed at once from the Gram
+        matrix of the points, which loses precision for close points: the
+        pairs within a rounding margin of `threshold` have their distances
+        computed again from the points, as :meth:`query` does.
+        """
         if not distance_func:
             distance_func = "euclidean"
+        matrix, _ = self._candidate_matrix(records)
+        stats = BinaryCodec.stats(matrix)
+        if distance_func == "l1norm":
+            # the l1 norm has no Gram form, the pairs are found row by row
+            rows, cols = [], []
+            for i in range(len(matrix) - 1):
+                close = np.flatnonzero(LSHash.l1norm_dists(matrix[i], matrix[i + 1:]) <= threshold)
+                rows.append(np.full(len(close), i))
+                cols.append(i + 1 + close)
+            rows, cols = np.concatenate(rows), np.concatenate(cols)
+        else:
+            rows, cols = np.triu_indices(len(matrix), k=1)
+            close = self._close_pairs(distance_func, matrix, stats, threshold)[rows, cols]
+            rows, cols = rows[close], cols[close]
+        distances = self._pair_dists(distance_func, matrix, stats, rows, cols)
+        close = np.flatnonzero(distances <= threshold)
+        return list(zip(rows[close].tolist(), cols[close].tolist(), distances[close]))
 
-        if distance_func == "hamming":
-            if not bitarray:
+    @staticmethod
+    def _close_pairs(distance_func, matrix, stats, threshold):
+        """ Returns the square boolean matrix of the pairs of rows of `matrix`
+        which may be at a distance lower or equal to `threshold`, from the
+        Gram matrix of the rows and a margin for its rounding errors. """
+        margin = 4 * matrix.shape[1] * np.finfo(float).eps
+        if distance_func in ("hamming", "euclidean", "true_euclidean"):
+            if distance_func == "hamming" and not _import_optional("bitarray"):
                 raise ImportError(" Bitarray is required for hamming distance")
+            if distance_func == "true_euclidean":
+                threshold = threshold * abs(threshold)
+            squares = stats[:, 0] ** 2
+            scale = squares[:, None] + squares[None, :]
+            return scale - 2 * matrix.dot(matrix.T) <= threshold + margin * scale
+        elif distance_func == "centred_euclidean":
+            diff = stats[:, 1][:, None] - stats[:, 1][None, :]
+            return diff * diff <= threshold + margin
+        elif distance_func == "cosine":
+            units = matrix / stats[:, :1]
+            return 1 - units.dot(units.T) <= threshold + margin
+        else:
+            raise ValueError("The distance function name is invalid.")
 
-            for i, table in enumerate(self.hash_tables):
-                binary_hash = self._hash(self.uniform_planes[i], query_point)
-                for key in table.keys():
-                    distance = LSHash.hamming_dist(key, binary_hash)
-                    if distance < 2:
-                        candidates.update(table.get_list(key, level))
+    @staticmethod
+    def _pair_dists(distance_func, matrix, stats, rows, cols):
+        """ Returns the distances of the pairs of rows `(rows[k], cols[k])` of
+        `matrix`, whose `(norm, mean)` are `stats`. """
+        xs, ys = matrix[rows], matrix[cols]
+        if distance_func in ("hamming", "euclidean"):
+            return LSHash.euclidean_dists_square(xs, ys)
+        elif distance_func == "true_euclidean":
+            return LSHash.euclidean_dists(xs, ys)
+        elif distance_func == "centred_euclidean":
+            return LSHash.euclidean_dists_centred(stats[rows, 1], stats[cols, 1])
+        elif distance_func == "cosine":
+            units = xs / stats[rows, :1]
+            return 1 - np.einsum("ij,ij->i", ys, units) / stats[cols, 0]
+        return LSHash.l1norm_dists(xs, ys)
+
+    @staticmethod
+    def _map_buckets(func, buckets, workers=None):
+        """ Yields the `(bucket, func(bucket))` of `buckets` in order, calling
+        `func` from `workers` threads if set. """
+        if not workers:
+            for bucket in buckets:
+                yield bucket, func(bucket)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # only a few buckets are read ahead of the results consumed
+            pending = deque()
+            for bucket in buckets:
+                pending.append((bucket, executor.submit(func, bucket)))
+                if len(pending) >= 2 * workers:
+                    bucket, future = pending.popleft()
+                    yield bucket, future.result()
+            while pending:
+                bucket, future = pending.popleft()
+                yield bucket, future.result()
+
+    def _get_distance_func(self, distance_func, query_point):
+        """ Returns the function ranking the candidates for the distance
+        function name `distance_func`.
+
+        The function takes the matrix of the candidate points, one per row,
+        and optionally the matrix of their `(norm, mean)` as cached by
+        :class:`storage.BinaryCodec`, and returns their distances to
+        `query_point`. The terms depending on `query_point` only, e.g. its
+        normalized form for "cosine", are computed once here.
+        """
+
+        if not distance_func:
+            distance_func = "euclidean"
+        query_point = np.asarray(query_point, dtype=float)
+
+        if distance_func == "hamming":
+            if not _import_optional("bitarray"):
+                raise ImportError(" Bitarray is required for hamming distance")
+            return lambda ys, stats=None: LSHash.euclidean_dists_square(query_point, ys)
+        elif distance_func == "euclidean":
+            return lambda ys, stats=None: LSHash.euclidean_dists_square(query_point, ys)
+        elif distance_func == "true_euclidean":
+            return lambda ys, stats=None: LSHash.euclidean_dists(query_point, ys)
+        elif distance_func == "centred_euclidean":
+            mean = query_point.mean()
 
-            d_func = LSHash.euclidean_dist_square
+            def d_func(ys, stats=None):
+                means = ys.mean(axis=1) if stats is None else stats[:, 1]
+                return LSHash.euclidean_dists_centred(mean, means)
+            return d_func
+        elif distance_func == "cosine":
+            # the norm is computed as the cached ones of the candidates
+            unit = query_point / np.sqrt(np.einsum("i,i", query_point, query_point))
 
+            def d_func(ys, stats=None):
+                norms = np.sqrt(np.einsum("ij,ij->i", ys, ys)) if stats is None else stats[:, 0]
+                return LSHash.cosine_dists(unit, ys, norms)
+            return d_func
+        elif distance_func == "l1norm":
+            return lambda ys, stats=None: LSHash.l1norm_dists(query_point, ys)
         else:
+            raise ValueError("The distance function name is invalid.")
 
-            if distance_func == "euclidean":
-                d_func = LSHash.euclidean_dist_square
-            elif distance_func == "true_euclidean":
-                d_func = LSHash.euclidean_dist
-            elif distance_func == "centred_euclidean":
-                d_func = LSHash.euclidean_dist_centred
-            elif distance_func == "cosine":
-                d_func = LSHash.cosine_dist
-            elif distance_func == "l1norm":
-                d_func = LSHash.l1norm_dist
-            else:
-                raise ValueError("The distance function name is invalid.")
+    def _query_keys(self, i, query_point, distance_func):
+        """ Returns the keys of the buckets of the `i`-th hash table holding
+        the candidates for `query_point`.
 
-            for i, table in enumerate(self.hash_tables):
-                binary_hash = self._hash(self.uniform_planes[i], query_point)
-                candidates.update(table.get_list(binary_hash, level))
+        For the hamming distance, these are all the buckets at a hamming
+        distance lower than 2, otherwise the bucket of `query_point`.
+        """
 
-        # rank candidates by distance function
-        candidates = [(ix, d_func(query_point, self._as_np_array(ix)))
-                      for ix in candidates]
-        candidates.sort(key=lambda x: x[1])
+        if distance_func != "hamming":
+            return [self._bucket_key(i, query_point)]
+        binary_hash = self._hash(self.uniform_planes[i], query_point)
+        # the keys of the split buckets have extra bits
+        return [key for key in self.hash_tables[i].keys()
+                if LSHash.hamming_dist(key[:self.hash_size], binary_hash) < 2]
 
-        return candidates[:num_results] if num_results else candidates
+    def _table_budget(self, budget, i):
+        """ Returns the part of the remaining candidate `budget` given to the
+        `i`-th hash table, or None if there is no budget. """
+        if budget is None:
+            return None
+        return max(budget, 0) // (len(self.hash_tables) - i)
+
+    @staticmethod
+    def _get_list(table, key, level, limit=None, raw=False):
+        get_list = table.get_raw_list if raw else table.get_list
+        if limit is None:
+            return get_list(key, level)
+        return get_list(key, level, limit)
+
+    def _raw_codec(self):
+        """ Returns the codec of the values stored in the hash tables if they
+        can be ranked from their serialized form, None otherwise. """
+        if self.record_store is not None:
+            return None
+        codecs = [table.codec for table in self.hash_tables]
+        return codecs[0] if all(codecs) else None
+
+    def _candidate_matrix(self, candidates, codec=None):
+        """ Returns the matrix of the points of `candidates`, one per row, and
+        the matrix of their `(norm, mean)` if `codec` is set, None otherwise.
+
+        If `codec` is set, `candidates` are values serialized by `codec`, their
+        points are decoded straight into the matrix.
+        """
+        if not candidates:
+            return np.empty((0, self.input_dim)), None
+        if codec:
+            matrix, _, stats = codec.loads_many(candidates, extras=False, stats=True)
+            return matrix, stats
+        return np.array([self._as_np_array(ix) for ix in candidates], dtype=float), None
+
+    def _rank(self, candidates, d_func, num_results=None, codec=None):
+        """ Returns the `num_results` best `(candidate, distance)` pairs of
+        `candidates` ranked by `d_func`, see :meth:`_get_distance_func`. All of
+        them if `num_results` is None.
+
+        If `codec` is set, `candidates` are values serialized by `codec`: their
+        points are decoded into one matrix, and only the returned candidates
+        are fully decoded.
+        """
+        candidates = list(candidates)
+        distances = d_func(*self._candidate_matrix(candidates, codec))
+        order = np.argsort(distances, kind="stable")
+        if not codec:
+            return [(candidates[row], distances[row]) for row in order[:num_results]]
+        ranked = {}
+        for row in order:
+            ix = _as_value(codec.loads(candidates[row]))
+            # the same value may be stored in both formats while migrating
+            ranked.setdefault(ix, distances[row])
+            if num_results and len(ranked) == num_results:
+                break
+        return list(ranked.items())
 
     ### distance functions
 
     @staticmethod
     def hamming_dist(bitarray1, bitarray2):
+        bitarray = _import_optional("bitarray").bitarray
         xor_result = bitarray(bitarray1) ^ bitarray(bitarray2)
         return xor_result.count()
 
@@ -338,16 +1129,45 @@ class LSHash(object):
 
     @staticmethod
     def l1norm_dist(x, y):
-        return sum(abs(x - y))
+        return np.abs(np.array(x) - y).sum()
 
     @staticmethod
     def cosine_dist(x, y):
         return 1 - np.dot(x, y) / ((np.dot(x, x) * np.dot(y, y)) ** 0.5)
 
+    ### vectorized distance functions, from `x` to the rows of `ys`, or from
+    ### the rows of `x` to the matching rows of `ys`
+
+    @staticmethod
+    def euclidean_dists(x, ys):
+        return np.sqrt(LSHash.euclidean_dists_square(x, ys))
+
+    @staticmethod
+    def euclidean_dists_square(x, ys):
+        diff = ys - x
+        return np.einsum("ij,ij->i", diff, diff)
+
+    @staticmethod
+    def euclidean_dists_centred(mean, means):
+        """ Takes the mean of `x` and the means of the rows of `ys`. """
+        diff = means - mean
+        return diff * diff
+
+    @staticmethod
+    def l1norm_dists(x, ys):
+        return np.abs(ys - x).sum(axis=1)
+
+    @staticmethod
+    def cosine_dists(unit, ys, norms):
+        """ Takes `x` normalized to a unit vector and the norms of the rows of
+        `ys`. """
+        return 1 - np.einsum("ij,j->i", ys, unit) / norms
+
 
 class MultiLevelLSHash(LSHash):
     def __init__(self, hash_size, input_dim, num_hashtables=1,
-                storage_config=None, matrices_filename=None, overwrite=False, levels=None):
+                storage_config=None, matrices_filename=None, overwrite=False, levels=None,
+                storage_layout="inline", table_offset=0):
         _storage_config = deepcopy(storage_config)
         if _storage_config is None:
             _storage_config = {'sqlite': {}}
@@ -356,4 +1176,5 @@ class MultiLevelLSHash(LSHash):
         if "sqlite" in _storage_config:
             _storage_config["sqlite"]["enabled_levels"] = True
         super().__init__(hash_size=hash_size, input_dim=input_dim, num_hashtables=num_hashtables,
-                 storage_config=_storage_config, matrices_filename=matrices_filename, overwrite=overwrite)
\ No newline at end of file
+                 storage_config=_storage_config, matrices_filename=matrices_filename, overwrite=overwrite,
+                 storage_layout=storage_layout, table_offset=table_offset)
\ No newline at end of file
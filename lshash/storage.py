@@ -7,20 +7,21 @@
 from __future__ import unicode_literals
 
 import json
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import bisect
 import hashlib
+import heapq
+import importlib
+import io
+import mmap
+import os
 import pickle
-try:
-    import joblib
-    import io
-except ImportError:
-    joblib = None
-import sqlite3
+import random
+import struct
+import sys
+import threading
 
-try:
-    import redis
-except ImportError:
-    redis = None
+import numpy as np
 
 
 Levels = namedtuple("Levels", ["High", "Medium", "Low"])("high", "medium", "low")
@@ -31,39 +32,101 @@ _LEVELS_KEY_COEFFICIENTS = {
 }
 
 
-__all__ = ['storage', 'serializer', 'BaseStorage', 'InMemoryStorage', 'RedisStorage', 'SQLiteStorage']
+__all__ = ['storage', 'register_storage', 'serializer', 'BinaryCodec', 'BaseStorage', 'InMemoryStorage', 'RedisStorage', 'SQLiteStorage',
+           'SegmentStorage', 'ShardedStorage', 'TieredStorage']
+
+# the optional dependencies are imported on first use, see `_import_optional`
+_OPTIONAL_MODULES = {}
+
+# registered storage classes by backend name, see `register_storage`
+_STORAGES = {}
+
+# entry points group of the third-party storages
+STORAGES_ENTRY_POINTS = "lshash.storages"
+
+
+def _import_optional(name):
+    """ Import and return the module `name`, or None if it is not installed.
+
+    The optional dependencies are slow to import, they are only imported when
+    a storage, or serializer, needing them is used.
+    """
+    if name not in _OPTIONAL_MODULES:
+        try:
+            _OPTIONAL_MODULES[name] = importlib.import_module(name)
+        except ImportError:
+            _OPTIONAL_MODULES[name] = None
+    return _OPTIONAL_MODULES[name]
+
+
+def register_storage(name, storage_class):
+    """ Register `storage_class` as the storage used for the backend `name`
+    of the storage configurations.
+
+    `storage_class` is called with the backend configuration and the index of
+    the hash table. Third-party storages can also be registered with an entry
+    point of the `lshash.storages` group, which is loaded on first use.
+    """
+    _STORAGES[name] = storage_class
+
+
+def _load_storage_entry_point(name):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            from pkg_resources import iter_entry_points
+        except ImportError:
+            return None
+        candidates = list(iter_entry_points(STORAGES_ENTRY_POINTS, name))
+    else:
+        candidates = entry_points()
+        if hasattr(candidates, "select"):
+            candidates = candidates.select(group=STORAGES_ENTRY_POINTS)
+        else:
+            candidates = candidates.get(STORAGES_ENTRY_POINTS, [])
+        candidates = [ep for ep in candidates if ep.name == name]
+    if not candidates:
+        return None
+    storage_class = candidates[0].load()
+    register_storage(name, storage_class)
+    return storage_class
+
 
 def storage(storage_config, index):
     """ Given the configuration for storage and the index, return the
     configured storage instance.
     """
-    if 'dict' in storage_config:
-        return InMemoryStorage(storage_config['dict'])
-    elif 'redis' in storage_config:
-        return RedisStorage(storage_config['redis'], index)
-    elif "sqlite" in storage_config:
-        return SQLiteStorage(storage_config['sqlite'], index)
-    else:
-        raise ValueError("Only in-memory dictionary and Redis are supported.")
+    for name, config in storage_config.items():
+        storage_class = _STORAGES.get(name) or _load_storage_entry_point(name)
+        if storage_class is not None:
+            return storage_class(config, index)
+    raise ValueError(f"No storage is registered for {', '.join(storage_config)}. "
+                     f"The registered storages are {', '.join(_STORAGES)}.")
 
 def _joblib_dumps(obj):
     buf = io.BytesIO()
-    joblib.dump(obj, buf)
+    _import_optional("joblib").dump(obj, buf)
     return buf.getvalue()
 
 def _joblib_loads(obj):
     buf = io.BytesIO(obj)
-    return joblib.load(buf)
+    return _import_optional("joblib").load(buf)
 
-def serializer(protocol=None):
+def serializer(protocol=None, legacy=None):
     """ Given a protocole, return the corresponding serializer
-    `protocol`: pickle | json
+    `protocol`: pickle | json | binary
+    `legacy`: for the binary protocol, the protocol of the values stored
+        before switching to the binary one, default: pickle
     """
     if protocol is None:
         protocol = "pickle"
     if protocol == "json":
         return json
+    elif protocol == "binary":
+        return BinaryCodec(serializer(legacy))
     else:
+        joblib = _import_optional("joblib")
         if joblib is not None:
             if not hasattr(joblib, 'dumps'):
                 joblib.dumps = _joblib_dumps
@@ -74,6 +137,154 @@ def serializer(protocol=None):
             return pickle
 
 
+class BinaryCodec(object):
+    """ Binary serializer of the stored values.
+
+    A value is encoded as a fixed size header, followed by the raw bytes of the
+    point as float32, by the norm and the mean of the point as float64, and by
+    the extra data, JSON-encoded if it is a string, a number or None, pickled
+    otherwise so that it is decoded unchanged. The header holds a magic
+    number, the format version, some flags, the dimension of the point and
+    the size of the extra data. The norm and the mean are
+    computed once when the value is stored, they are absent from the values
+    stored with the version 1 of the format.
+
+    Values that are not in the binary format are decoded with the `legacy`
+    serializer, which allows reading the values stored before switching to
+    the binary format.
+    """
+
+    MAGIC = b"LSHB"
+    VERSION = 2
+    HEADER = struct.Struct("<4sBBHII")
+    STATS = struct.Struct("<dd")
+    DTYPE = np.dtype("<f4")
+    HAS_EXTRA = 0x1
+    PICKLED_EXTRA = 0x2
+    HAS_STATS = 0x4
+
+    def __init__(self, legacy=None):
+        self.legacy = legacy if legacy is not None else pickle
+
+    def dumps(self, val):
+        if isinstance(val, str):
+            # the ids of the records are not points
+            return self.legacy.dumps(val)
+        if len(val) == 2 and isinstance(val[0], (tuple, list)):
+            point, extra = val
+            if extra is None or isinstance(extra, (str, int, float)):
+                extra = json.dumps(extra).encode()
+                flags = self.HAS_EXTRA
+            else:
+                # e.g. a tuple would be decoded from JSON as an unhashable list
+                extra = pickle.dumps(extra)
+                flags = self.HAS_EXTRA | self.PICKLED_EXTRA
+        else:
+            point, extra, flags = val, b"", 0
+        point = np.asarray(point, dtype=self.DTYPE)
+        norm, mean = self.stats(point[np.newaxis])[0]
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, 0, flags | self.HAS_STATS, len(point), len(extra))
+        return header + point.tobytes() + self.STATS.pack(norm, mean) + extra
+
+    @staticmethod
+    def stats(matrix):
+        """ Returns the norms and the means of the rows of `matrix`, as a
+        matrix with one `(norm, mean)` row per row of `matrix`. """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        stats = np.empty((len(matrix), 2))
+        stats[:, 0] = np.sqrt(np.einsum("ij,ij->i", matrix, matrix))
+        stats[:, 1] = matrix.mean(axis=1) if matrix.shape[1] else 0
+        return stats
+
+    def is_binary(self, blob):
+        return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(blob[:len(self.MAGIC)]) == self.MAGIC
+
+    def _header(self, blob):
+        _, version, _, flags, dim, extra_size = self.HEADER.unpack_from(blob)
+        if version > self.VERSION:
+            raise ValueError(f"Unsupported binary format version: {version}")
+        return flags, dim, extra_size
+
+    def _extra(self, blob, flags, dim, extra_size):
+        offset = self.HEADER.size + dim * self.DTYPE.itemsize
+        if flags & self.HAS_STATS:
+            offset += self.STATS.size
+        extra = bytes(blob[offset:offset + extra_size])
+        if flags & self.PICKLED_EXTRA:
+            return pickle.loads(extra)
+        return json.loads(extra.decode())
+
+    def loads(self, blob):
+        if not self.is_binary(blob):
+            return self.legacy.loads(blob)
+        flags, dim, extra_size = self._header(blob)
+        point = tuple(np.frombuffer(blob, self.DTYPE, dim, self.HEADER.size).tolist())
+        if flags & self.HAS_EXTRA:
+            return (point, self._extra(blob, flags, dim, extra_size))
+        return point
+
+    def loads_many(self, blobs, out=None, extras=True, stats=False):
+        """ Decode `blobs` into a matrix with one point per row, and the list
+        of their extra data (None for the points without extra data).
+
+        :param out:
+            (optional) preallocated float matrix to decode the points into. It
+            needs at least `len(blobs)` rows.
+        :param extras:
+            (optional) Whether to decode the extra data, the list of the extra
+            data is None otherwise.
+        :param stats:
+            (optional) Whether to also return the matrix of the `(norm, mean)`
+            of the points, see :meth:`stats`. The stored ones are used, they
+            are only computed for the values stored without them.
+        """
+        decoded_extras = []
+        decoded_stats = np.empty((len(blobs), 2)) if stats else None
+        missing_stats = []
+        for row, blob in enumerate(blobs):
+            if self.is_binary(blob):
+                flags, dim, extra_size = self._header(blob)
+                point = np.frombuffer(blob, self.DTYPE, dim, self.HEADER.size)
+                extra = None
+                if extras and flags & self.HAS_EXTRA:
+                    extra = self._extra(blob, flags, dim, extra_size)
+                if stats and flags & self.HAS_STATS:
+                    decoded_stats[row] = self.STATS.unpack_from(blob, self.HEADER.size + point.nbytes)
+                else:
+                    missing_stats.append(row)
+            else:
+                val = self.legacy.loads(blob)
+                if len(val) == 2 and isinstance(val[0], (tuple, list)):
+                    point, extra = np.asarray(val[0]), val[1]
+                else:
+                    point, extra = np.asarray(val), None
+                missing_stats.append(row)
+            if out is None:
+                out = np.empty((len(blobs), len(point)), dtype=self.DTYPE)
+            out[row] = point
+            decoded_extras.append(extra)
+        if out is None:
+            out = np.empty((0, 0), dtype=self.DTYPE)
+        out = out[:len(blobs)]
+        if not stats:
+            return out, decoded_extras if extras else None
+        if missing_stats:
+            decoded_stats[missing_stats] = self.stats(out[missing_stats])
+        return out, decoded_extras if extras else None, decoded_stats
+
+
+def _as_value(el):
+    """ Returns the deserialized value `el`, where lists are turned back into
+    tuples, as stored by :meth:`LSHash.index`. """
+    if isinstance(el, str):
+        # the id of a record
+        return el
+    # if len(el) is 2, then el[1] is the extra value associated to the element
+    if len(el) == 2 and type(el[0]) == list:
+        return (tuple(el[0]), el[1])
+    return tuple(el)
+
+
 def _compute_hash(message):
     if isinstance(message, bytes):
         raw_message = message
@@ -82,6 +293,38 @@ def _compute_hash(message):
     return hashlib.sha1(raw_message).hexdigest()
     
 class BaseStorage(object):
+    """ Base class of the storages.
+
+    The size of the buckets can be bounded with the following options of the
+    storage configuration:
+
+        bucket_limit: max number of values per bucket, default: None (no limit)
+        bucket_overflow: 'reservoir'|'split', default: 'reservoir'
+            'reservoir': keep a uniform sample of `bucket_limit` of the values
+                appended to the bucket (reservoir sampling)
+            'split': split the overfull bucket by adding extra hash bits to the
+                keys of its values, see :meth:`LSHash.index`
+        max_split_bits: max number of extra hash bits of a split bucket, default: 8
+    """
+
+    bucket_limit = None
+    bucket_overflow = "reservoir"
+    max_split_bits = 8
+    split_keys = frozenset()
+
+    def _configure_buckets(self, config):
+        """ Set the bucket options from `config` and return `config` without them. """
+        config = dict(config or {})
+        self.bucket_limit = config.pop("bucket_limit", None)
+        self.bucket_overflow = config.pop("bucket_overflow", "reservoir")
+        self.max_split_bits = config.pop("max_split_bits", 8)
+        if self.bucket_overflow not in ("reservoir", "split"):
+            raise ValueError("The bucket overflow should be either 'reservoir' or 'split'.")
+        # number of values appended to each bucket, used by the reservoir sampling
+        self._seen = {}
+        self.split_keys = set()
+        return config
+
     def keys(self, level=None):
         """ Returns a list of binary hashes that are used as dict keys. """
         raise NotImplementedError
@@ -94,58 +337,227 @@ class BaseStorage(object):
         """
         raise NotImplementedError
 
-    def get_list(self, key, level=None):
+    def get_list(self, key, level=None, limit=None):
         """ Returns a list stored in storage at `key`.
 
         This method should return a list of values stored at `key`. `[]` should
         be returned if the list is empty or if `key` is not present in storage.
+        If `limit` is set, at most `limit` of the values are returned.
         """
         raise NotImplementedError
 
+    @property
+    def codec(self):
+        """ The :class:`BinaryCodec` of the stored values, if they are stored
+        in the binary format, None otherwise. See :meth:`get_raw_list`. """
+        codec = getattr(self, "serializer", None)
+        return codec if isinstance(codec, BinaryCodec) else None
+
+    def get_raw_list(self, key, level=None, limit=None):
+        """ Like :meth:`get_list`, but returns the values as they are stored,
+        serialized by :attr:`codec`. This allows decoding the candidates of a
+        query straight into one matrix. """
+        raise NotImplementedError
+
+    def set_records(self, records):
+        """ Store the `{id: value}` records.
+
+        The records hold the values once, while the hash tables only hold
+        their ids, see the `storage_layout` of :class:`LSHash`.
+        """
+        raise NotImplementedError
+
+    def get_records(self, ids):
+        """ Returns the values of the records `ids`, fetched in one batch.
+
+        None is returned for the ids which are not stored.
+        """
+        raise NotImplementedError
+
+    def bucket_size(self, key):
+        """ Returns the number of values stored at `key`. """
+        return len(self.get_list(key))
+
+    def remove_random_val(self, key):
+        """ Remove a value, chosen at random, from the list stored at `key`. """
+        raise NotImplementedError
+
+    def pop_list(self, key):
+        """ Remove the list stored at `key` and return it. """
+        raise NotImplementedError
+
+    def migrate(self):
+        """ Re-encode the stored values with the configured serializer, e.g.
+        after switching to the binary serializer. """
+        pass
+
+    def flush(self):
+        """ Write the buffered values to the storage. """
+        pass
+
+    def close(self):
+        """ Flush and release the resources of the storage, which is not
+        usable anymore. """
+        self.flush()
+
+    def _admit(self, key):
+        """ Returns whether a new value can be appended at `key`, making room
+        for it if needed. """
+        if not self.bucket_limit or self.bucket_overflow != "reservoir":
+            return True
+        size = self.bucket_size(key)
+        seen = self._seen.get(key, size) + 1
+        self._seen[key] = seen
+        if size < self.bucket_limit:
+            return True
+        if random.randrange(seen) < self.bucket_limit:
+            self.remove_random_val(key)
+            return True
+        return False
+
+    def is_overfull(self, key):
+        """ Returns whether the bucket stored at `key` needs to be split. """
+        return (self.bucket_overflow == "split" and self.bucket_limit is not None
+                and self.bucket_size(key) > self.bucket_limit)
+
+    def is_split(self, key):
+        """ Returns whether the bucket stored at `key` has been split. """
+        return key in self.split_keys
+
+    def mark_split(self, key):
+        """ Record that the bucket stored at `key` has been split. """
+        self.split_keys.add(key)
+
 
 class InMemoryStorage(BaseStorage):
-    def __init__(self, h_index):
+    def __init__(self, config, h_index=None):
         self.name = 'dict'
         self.storage = dict()
+        self.records = dict()
+        self._configure_buckets(config)
 
     def keys(self, level=None):
         return self.storage.keys()
 
     def append_val(self, key, val):
+        if val in self.storage.get(key, ()) or not self._admit(key):
+            return
         self.storage.setdefault(key, set()).update([val])
 
-    def get_list(self, key, level=None):
-        return list(self.storage.get(key, []))
+    def get_list(self, key, level=None, limit=None):
+        values = list(self.storage.get(key, []))
+        if limit is not None and limit < len(values):
+            return random.sample(values, limit)
+        return values
+
+    def bucket_size(self, key):
+        return len(self.storage.get(key, ()))
+
+    def remove_random_val(self, key):
+        values = self.storage[key]
+        values.remove(random.choice(tuple(values)))
+
+    def pop_list(self, key):
+        return list(self.storage.pop(key, []))
+
+    def set_records(self, records):
+        self.records.update(records)
+
+    def get_records(self, ids):
+        return [self.records.get(record_id) for record_id in ids]
 
 
 class RedisStorage(BaseStorage):
     def __init__(self, config, h_index):
+        redis = _import_optional("redis")
         if not redis:
             raise ImportError("redis-py is required to use Redis as storage.")
         self.name = 'redis'
+        config = self._configure_buckets(config)
+        # 'json'|'binary', default: 'json'
+        self.serializer = serializer(config.pop("serializer", "json"), "json")
         self.storage = redis.StrictRedis(**config)
         # a single db handles multiple hash tables, each one has prefix ``h[h_index].``
         self.h_index = 'h%.2i.' % int(h_index)
+        # the keys of the split buckets and the records are kept out of the ``h[h_index].*`` keys
+        self._split_keys_key = 'h%.2i:split' % int(h_index)
+        self._records_key = 'lshash:records'
+        if self.bucket_overflow == "split":
+            self.split_keys = {k.decode('ascii') for k in self.storage.smembers(self._split_keys_key)}
 
     def _list(self, key):
         return self.h_index + key
 
+    def _decode(self, el):
+        return _as_value(self.serializer.loads(el))  # transform strings into python tuples
+
+    def _encode(self, val):
+        val = self.serializer.dumps(val)
+        return val.encode() if isinstance(val, str) else val
+
     def keys(self, pattern='*', level=None):
         # return the keys BUT be agnostic with reference to the hash table
         return [k.decode('ascii').split('.')[1] for k in self.storage.keys(self.h_index + pattern)]
 
     def append_val(self, key, val):
-        self.storage.sadd(self._list(key), json.dumps(val))
-
-    def get_list(self, key, level=None):
-        _list = list(self.storage.smembers(self._list(key)))  # list elements are plain strings here
-        _list = [json.loads(el.decode('ascii')) for el in _list]  # transform strings into python tuples
-        for el in _list:
-            # if len(el) is 2, then el[1] is the extra value associated to the element
-            if len(el) == 2 and type(el[0]) == list:
-                el[0] = tuple(el[0])
-        _list = [tuple(el) for el in _list]
-        return _list
+        val = self._encode(val)
+        if self.bucket_limit and self.storage.sismember(self._list(key), val):
+            return
+        if self._admit(key):
+            self.storage.sadd(self._list(key), val)
+
+    def get_list(self, key, level=None, limit=None):
+        # list elements are plain strings here
+        return [self._decode(el) for el in self.get_raw_list(key, level, limit)]
+
+    def get_raw_list(self, key, level=None, limit=None):
+        if limit is None:
+            return list(self.storage.smembers(self._list(key)))
+        return self.storage.srandmember(self._list(key), limit)
+
+    def bucket_size(self, key):
+        return self.storage.scard(self._list(key))
+
+    def remove_random_val(self, key):
+        self.storage.spop(self._list(key))
+
+    def pop_list(self, key):
+        pipeline = self.storage.pipeline()
+        pipeline.smembers(self._list(key))
+        pipeline.delete(self._list(key))
+        _list, _ = pipeline.execute()
+        return [self._decode(el) for el in _list]
+
+    def mark_split(self, key):
+        self.storage.sadd(self._split_keys_key, key)
+        super().mark_split(key)
+
+    def set_records(self, records):
+        pipeline = self.storage.pipeline()
+        for record_id, val in records.items():
+            pipeline.hset(self._records_key, record_id, self._encode(val))
+        pipeline.execute()
+
+    def get_records(self, ids):
+        if not ids:
+            return []
+        return [None if el is None else self._decode(el)
+                for el in self.storage.hmget(self._records_key, list(ids))]
+
+    def migrate(self):
+        for record_id, el in self.storage.hgetall(self._records_key).items():
+            encoded = self._encode(self._decode(el))
+            if encoded != el:
+                self.storage.hset(self._records_key, record_id, encoded)
+        for key in self.keys():
+            name = self._list(key)
+            pipeline = self.storage.pipeline()
+            for el in self.storage.smembers(name):
+                encoded = self._encode(self._decode(el))
+                if encoded != el:
+                    pipeline.srem(name, el)
+                    pipeline.sadd(name, encoded)
+            pipeline.execute()
 
 class SQLiteStorage(BaseStorage):
     def __init__(self, config, h_index):
@@ -155,31 +567,44 @@ class SQLiteStorage(BaseStorage):
             key_column: name of the column to hold the key, default: 'key'
             value_column: name of the column to hold the value, default: 'value'
             database: path to the database, default: ':memory:'
-            serializer: 'json'|'pickle', default: 'pickle'
+            serializer: 'json'|'pickle'|'binary', default: 'pickle'
+            legacy_serializer: 'json'|'pickle', the serializer of the values stored
+                before switching to the 'binary' one, default: 'pickle'
             enabled_levels: if True, add 2 more keys, which are derivated from the key for each item
+            bucket_limit, bucket_overflow, max_split_bits: see :class:`BaseStorage`
         """
         super().__init__()
         self.name = "sqlite"
+        config = self._configure_buckets(config)
         self.config = {
             "table": "lshash",
             "key_column": "key",
             "value_column": "value",
             "database": ":memory:",
             "serializer": None,
+            "legacy_serializer": None,
             "enabled_levels": None
         }
-        if config is None:
-            self.config['serializer'] = serializer()
-        else:
-            self.config.update(config)
-            self.config["serializer"] = serializer(config.get("serializer"))
-        connection = sqlite3.connect(self.config["database"])
+        self.config.update(config)
+        self.config["serializer"] = serializer(config.get("serializer"), self.config["legacy_serializer"])
+        sqlite3 = _import_optional("sqlite3")
+        if not sqlite3:
+            raise ImportError("sqlite3 is required to use SQLite as storage.")
+        # the connection may be used by the worker threads of a sharded storage,
+        # its statements are run under the lock
+        connection = sqlite3.connect(self.config["database"], check_same_thread=False)
         self.config["connection"] = connection
+        self._lock = threading.RLock()
         if h_index:
-            table = f"{self.table}.{h_index}"
-        else:
-            table = self.table
-        self._create_table(table, self.key_column, self.value_column, self.value_hash_column)
+            self.config["table"] = f"{self.table}_{h_index}"
+        self._records_table_created = False
+        self._create_table(self.table, self.key_column, self.value_column, self.value_hash_column)
+        if self.bucket_overflow == "split":
+            with self._lock, self.connection as con:
+                con.execute(f"CREATE TABLE IF NOT EXISTS {self.split_table} ({self.key_column} Text PRIMARY KEY)")
+            with self._lock:
+                self.split_keys = {row[0] for row in self.connection.execute(
+                    f"SELECT {self.key_column} FROM {self.split_table}")}
 
     def _create_table(self, table, key_column, value_column, value_hash_column):
         sql_indexes_create_statements = []
@@ -197,7 +622,7 @@ class SQLiteStorage(BaseStorage):
             sql_create_index_key = f"CREATE INDEX IF NOT EXISTS {table}_{key_column} ON {table}({key_column})"
             sql_create_index_value = f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_{value_hash_column} ON {table}({key_column}, {value_hash_column})"
             sql_indexes_create_statements.extend([sql_create_index_key, sql_create_index_value])
-        with self.connection as con:
+        with self._lock, self.connection as con:
             con.execute(sql_create_table)
             # con.execute(sql_create_index_key)
             # con.execute(sql_create_index_value)
@@ -223,7 +648,8 @@ class SQLiteStorage(BaseStorage):
             sql = f"SELECT DISTINCT({level_key_column}) FROM {self.table}"
         else:
             sql = f"SELECT DISTINCT({self.key_column}) FROM {self.table}"
-        raw_result = self.connection.execute(sql).fetchall()
+        with self._lock:
+            raw_result = self.connection.execute(sql).fetchall()
         result = [item[0] for item in raw_result]
         return result
 
@@ -241,13 +667,25 @@ class SQLiteStorage(BaseStorage):
         else:
             sql = f"INSERT INTO {self.table} ({self.key_column}, {self.value_column}, {self.value_hash_column}) VALUES(?, ?, ?)"
             params = [key, serialized_value, serialized_value_hash]
-        with self.connection as con:
-            try:
-                con.execute(sql, params)
-            except sqlite3.IntegrityError:
-                pass
+        with self._lock:
+            if self.bucket_limit:
+                exists = (f"SELECT 1 FROM {self.table} "
+                          f"WHERE {self.bucket_key_column} = ? AND {self.value_hash_column} = ?")
+                if self.connection.execute(exists, [key, serialized_value_hash]).fetchone() or not self._admit(key):
+                    return
+            with self.connection as con:
+                try:
+                    con.execute(sql, params)
+                except con.IntegrityError:
+                    pass
+
+    def _loads(self, raw_result):
+        return [_as_value(self.serializer.loads(value[0])) for value in raw_result]
 
-    def get_list(self, key, level=None):
+    def get_list(self, key, level=None, limit=None):
+        return [_as_value(self.serializer.loads(value)) for value in self.get_raw_list(key, level, limit)]
+
+    def get_raw_list(self, key, level=None, limit=None):
         if level is None:
             level = Levels.High
         if self.enabled_levels:
@@ -255,21 +693,89 @@ class SQLiteStorage(BaseStorage):
             sql = f"SELECT value FROM {self.table} WHERE {level_key_column} like ?"
         else:
             sql = f"SELECT value FROM {self.table} WHERE {self.key_column} like ?"
-        with self.connection as con:
-            raw_result = con.execute(sql, [key]).fetchall()
-        result = [self.serializer.loads(value[0]) for value in raw_result]
-        for el in raw_result:
-            # if len(el) is 2, then el[1] is the extra value associated to the element
-            if len(el) == 2 and type(el[0]) == list:
-                el[0] = tuple(el[0])
-        return [tuple(val) for val in result]
-    
+        params = [key]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock, self.connection as con:
+            raw_result = con.execute(sql, params).fetchall()
+        return [value[0] for value in raw_result]
+
+    def bucket_size(self, key):
+        sql = f"SELECT COUNT(*) FROM {self.table} WHERE {self.bucket_key_column} = ?"
+        with self._lock:
+            return self.connection.execute(sql, [key]).fetchone()[0]
+
+    def remove_random_val(self, key):
+        sql = (f"DELETE FROM {self.table} WHERE rowid = (SELECT rowid FROM {self.table} "
+               f"WHERE {self.bucket_key_column} = ? ORDER BY RANDOM() LIMIT 1)")
+        with self._lock, self.connection as con:
+            con.execute(sql, [key])
+
+    def pop_list(self, key):
+        with self._lock, self.connection as con:
+            raw_result = con.execute(f"SELECT value FROM {self.table} WHERE {self.bucket_key_column} = ?",
+                                     [key]).fetchall()
+            con.execute(f"DELETE FROM {self.table} WHERE {self.bucket_key_column} = ?", [key])
+        return self._loads(raw_result)
+
+    def mark_split(self, key):
+        with self._lock, self.connection as con:
+            con.execute(f"INSERT OR IGNORE INTO {self.split_table} ({self.key_column}) VALUES(?)", [key])
+        super().mark_split(key)
+
+    def _create_records_table(self):
+        if not self._records_table_created:
+            with self._lock, self.connection as con:
+                con.execute(f"CREATE TABLE IF NOT EXISTS {self.records_table} (id Text PRIMARY KEY, {self.value_column} Blob)")
+            self._records_table_created = True
+
+    def set_records(self, records):
+        self._create_records_table()
+        sql = f"INSERT OR REPLACE INTO {self.records_table} (id, {self.value_column}) VALUES(?, ?)"
+        with self._lock, self.connection as con:
+            con.executemany(sql, [(record_id, self.serializer.dumps(val)) for record_id, val in records.items()])
+
+    def get_records(self, ids):
+        self._create_records_table()
+        ids = list(ids)
+        values = {}
+        # stay below the max number of parameters of a statement
+        for start in range(0, len(ids), 900):
+            chunk = ids[start:start + 900]
+            sql = (f"SELECT id, {self.value_column} FROM {self.records_table} "
+                   f"WHERE id IN ({','.join(['?'] * len(chunk))})")
+            with self._lock:
+                values.update(self.connection.execute(sql, chunk).fetchall())
+        return [None if record_id not in values else _as_value(self.serializer.loads(values[record_id]))
+                for record_id in ids]
+
+    def migrate(self):
+        self._create_records_table()
+        with self._lock, self.connection as con:
+            for record_id, value in con.execute(f"SELECT id, {self.value_column} FROM {self.records_table}").fetchall():
+                serialized_value = self.serializer.dumps(_as_value(self.serializer.loads(value)))
+                if serialized_value != value:
+                    con.execute(f"UPDATE {self.records_table} SET {self.value_column} = ? WHERE id = ?",
+                                [serialized_value, record_id])
+        sql = f"UPDATE OR REPLACE {self.table} SET {self.value_column} = ?, {self.value_hash_column} = ? WHERE rowid = ?"
+        with self._lock, self.connection as con:
+            rows = con.execute(f"SELECT rowid, {self.value_column} FROM {self.table}").fetchall()
+            for rowid, value in rows:
+                serialized_value = self.serializer.dumps(self._loads([(value,)])[0])
+                if serialized_value != value:
+                    con.execute(sql, [serialized_value, _compute_hash(serialized_value), rowid])
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
     @property
     def serializer(self):
         return self.config["serializer"]
 
     @property
-    def connection(self) -> sqlite3.Connection:
+    def connection(self) -> "sqlite3.Connection":
         return self.config["connection"]
 
     @property
@@ -291,3 +797,928 @@ class SQLiteStorage(BaseStorage):
     @property
     def enabled_levels(self) -> bool:
         return self.config["enabled_levels"]
+
+    @property
+    def bucket_key_column(self) -> str:
+        """ The column holding the full key of the values """
+        if self.enabled_levels:
+            return self._get_level_key_column(Levels.High)
+        return self.key_column
+
+    @property
+    def split_table(self) -> str:
+        return f"{self.table}_split"
+
+    @property
+    def records_table(self) -> str:
+        return f"{self.table}_records"
+
+
+class SegmentStorage(BaseStorage):
+    """ Log-structured storage, for fast embedded and persistent ingestion.
+
+    The values are appended to segment files. When enough segments are sealed,
+    they are merged, in a background thread, with the base segment: a file
+    where the values of each key are stored contiguously, sorted by key. A
+    memory-mapped directory maps each key of the base segment to the
+    position of its values, which are read with a single sequential read.
+    """
+
+    # types of the records of the segments
+    APPEND, DELETE_KEY, DELETE_VALUE = 0, 1, 2
+    # record type, key size and value size, followed by the key and the value
+    RECORD = struct.Struct("<BHI")
+    DIRECTORY_MAGIC = b"LSHD"
+    DIRECTORY_VERSION = 1
+    # magic, version, key width and number of entries
+    DIRECTORY_HEADER = struct.Struct("<4sHHQ")
+    # after the key, padded to the key width: offset, size and count of the values
+    DIRECTORY_ENTRY = struct.Struct("<QQI")
+
+    def __init__(self, config, h_index):
+        """
+        config:
+            path: path to the directory of the segment files, required
+            serializer: 'json'|'pickle'|'binary', default: 'pickle'
+            legacy_serializer: see :class:`SQLiteStorage`
+            segment_size: size in bytes after which a segment is sealed, default: 16 MiB
+            merge_segments: number of sealed segments triggering a merge, default: 4
+            background_merge: whether the merges run in a background thread, default: True
+            sync: whether the files are synced to the disk when a segment is
+                sealed or flushed, and when the segments are merged, default: False
+            bucket_limit, bucket_overflow, max_split_bits: see :class:`BaseStorage`
+
+        The values are buffered, they are written to the segment when it is
+        sealed, or by :meth:`flush` and :meth:`close`.
+        """
+        super().__init__()
+        self.name = "segment"
+        config = self._configure_buckets(config)
+        self.config = {
+            "path": None,
+            "serializer": None,
+            "legacy_serializer": None,
+            "segment_size": 16 * 2 ** 20,
+            "merge_segments": 4,
+            "background_merge": True,
+            "sync": False,
+        }
+        self.config.update(config)
+        if self.config["path"] is None:
+            raise ValueError("The path of the directory of the segment files is required.")
+        os.makedirs(self.path, exist_ok=True)
+        self.serializer = serializer(self.config["serializer"], self.config["legacy_serializer"])
+        self.prefix = f"h{h_index}"
+
+        self._lock = threading.RLock()
+        self._merge_lock = threading.Lock()
+        self._merge_thread = None
+        # the base segment, its directory and the last segment merged in it
+        self._base_seq = -1
+        self._base = self._directory = None
+        # the values appended to the live segments, key -> [(seq, offset, size)]
+        self._live = {}
+        # the base values masked by a later `pop_list`, key -> seq
+        self._masked = {}
+        # the base values removed by `remove_random_val`, key -> {value: seq}
+        self._removed = {}
+        self._sealed = []
+        self._readers = {}
+        self._active_seq = None
+        self._records_segments = None
+        self._open()
+
+    @property
+    def path(self):
+        return self.config["path"]
+
+    def _file(self, seq, extension):
+        return os.path.join(self.path, f"{self.prefix}-{seq:08d}.{extension}")
+
+    def _open(self):
+        """ Load the base segment and replay the live segments. """
+        files = {}
+        for name in os.listdir(self.path):
+            prefix, _, rest = name.partition("-")
+            seq, _, extension = rest.partition(".")
+            if prefix == self.prefix and seq.isdigit():
+                files.setdefault(extension, set()).add(int(seq))
+        bases = files.get("base", set()) & files.get("dir", set())
+        if bases:
+            self._base_seq = max(bases)
+            self._base, self._directory = self._map_base(self._base_seq)
+        # remove the files of the previous, or unfinished, merges
+        for extension, seqs in files.items():
+            for seq in seqs:
+                if extension != "seg" and seq != self._base_seq or extension == "seg" and seq <= self._base_seq:
+                    os.remove(self._file(seq, extension))
+        segments = sorted(seq for seq in files.get("seg", ()) if seq > self._base_seq)
+        for seq in segments:
+            self._replay(seq)
+        self._sealed = segments
+        self._start_segment(max(segments + [self._base_seq]) + 1)
+        split_file = os.path.join(self.path, f"{self.prefix}.split")
+        if os.path.exists(split_file):
+            with open(split_file) as f:
+                self.split_keys = set(f.read().split())
+
+    def _map_base(self, seq):
+        maps = []
+        for extension in ("base", "dir"):
+            with open(self._file(seq, extension), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None)
+        return maps
+
+    def _start_segment(self, seq):
+        self._active_seq = seq
+        self._active = open(self._file(seq, "seg"), "ab")
+        self._active_size = self._active.tell()
+
+    def _records(self, data):
+        """ Yields the `(type, key, value offset, value)` records of `data`. """
+        offset = 0
+        while offset + self.RECORD.size <= len(data):
+            record_type, key_size, value_size = self.RECORD.unpack_from(data, offset)
+            key_offset = offset + self.RECORD.size
+            value_offset = key_offset + key_size
+            end = value_offset + value_size
+            if end > len(data):
+                # truncated record, at the end of a segment which was not fully written
+                break
+            key = bytes(data[key_offset:value_offset]).decode("ascii")
+            yield record_type, key, value_offset, bytes(data[value_offset:end])
+            offset = end
+
+    def _replay(self, seq):
+        with open(self._file(seq, "seg"), "rb") as f:
+            data = f.read()
+        end = 0
+        for record_type, key, offset, value in self._records(data):
+            self._apply(seq, record_type, key, offset, value)
+            end = offset + len(value)
+        if end < len(data):
+            with open(self._file(seq, "seg"), "r+b") as f:
+                f.truncate(end)
+
+    def _apply(self, seq, record_type, key, offset, value):
+        if record_type == self.APPEND:
+            self._live.setdefault(key, []).append((seq, offset, len(value)))
+        elif record_type == self.DELETE_KEY:
+            self._live.pop(key, None)
+            self._removed.pop(key, None)
+            self._masked[key] = seq
+        elif record_type == self.DELETE_VALUE:
+            entries = self._live.get(key, [])
+            entries[:] = [entry for entry in entries if self._read(*entry) != value]
+            self._removed.setdefault(key, {})[value] = seq
+
+    def _append_record(self, record_type, key, value=b""):
+        raw_key = key.encode("ascii")
+        with self._lock:
+            self._active.write(self.RECORD.pack(record_type, len(raw_key), len(value)) + raw_key + value)
+            offset = self._active_size + self.RECORD.size + len(raw_key)
+            self._active_size = offset + len(value)
+            self._apply(self._active_seq, record_type, key, offset, value)
+            if self._active_size >= self.config["segment_size"]:
+                self._seal()
+                if len(self._sealed) >= self.config["merge_segments"]:
+                    self._start_merge()
+
+    def _write_out(self, f):
+        """ Write the buffer of the file `f` to the OS, and to the disk if
+        `sync` is set. """
+        f.flush()
+        if self.config["sync"]:
+            os.fsync(f.fileno())
+
+    def flush(self):
+        if self._records_segments is not None:
+            self._records_segments.flush()
+        with self._lock:
+            self._write_out(self._active)
+
+    def _seal(self):
+        """ Seal the active segment and start a new one. """
+        self._write_out(self._active)
+        self._active.close()
+        self._sealed.append(self._active_seq)
+        self._start_segment(self._active_seq + 1)
+
+    def _read(self, seq, offset, size):
+        if seq == self._active_seq:
+            self._active.flush()
+        reader = self._readers.get(seq)
+        if reader is None:
+            reader = self._readers[seq] = open(self._file(seq, "seg"), "rb")
+        reader.seek(offset)
+        return reader.read(size)
+
+    def _base_entry(self, key):
+        """ Returns the `(offset, size, count)` of the values of `key` in the
+        base segment, by binary search in the directory. """
+        directory = self._directory
+        if directory is None:
+            return None
+        _, _, key_width, count = self.DIRECTORY_HEADER.unpack_from(directory)
+        raw_key = key.encode("ascii")
+        if len(raw_key) > key_width:
+            return None
+        raw_key = raw_key.ljust(key_width, b"\0")
+        entry_size = key_width + self.DIRECTORY_ENTRY.size
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = self.DIRECTORY_HEADER.size + middle * entry_size
+            middle_key = directory[position:position + key_width]
+            if middle_key < raw_key:
+                low = middle + 1
+            elif middle_key > raw_key:
+                high = middle
+            else:
+                return self.DIRECTORY_ENTRY.unpack_from(directory, position + key_width)
+        return None
+
+    def _base_keys(self):
+        directory = self._directory
+        if directory is None:
+            return
+        _, _, key_width, count = self.DIRECTORY_HEADER.unpack_from(directory)
+        entry_size = key_width + self.DIRECTORY_ENTRY.size
+        for i in range(count):
+            position = self.DIRECTORY_HEADER.size + i * entry_size
+            yield directory[position:position + key_width].rstrip(b"\0").decode("ascii")
+
+    def _base_values(self, key):
+        entry = self._base_entry(key)
+        if entry is None:
+            return []
+        offset, size, _ = entry
+        # the values of a key are contiguous in the base segment
+        return [value for _, _, _, value in self._records(self._base[offset:offset + size])]
+
+    def _raw_values(self, key):
+        """ Returns the distinct serialized values stored at `key`. """
+        with self._lock:
+            values = []
+            if key not in self._masked:
+                removed = self._removed.get(key, ())
+                values.extend(value for value in self._base_values(key) if value not in removed)
+            values.extend(self._read(*entry) for entry in self._live.get(key, ()))
+        return list(dict.fromkeys(values))
+
+    def _first_raw_values(self, keys):
+        """ Returns the first serialized value stored at each of `keys`, or
+        None, in one batch: the base values are read from the memory-mapped
+        base segment, the live values are read in file order. """
+        keys = list(keys)
+        values = [None] * len(keys)
+        with self._lock:
+            live = []
+            for i, key in enumerate(keys):
+                if self._live.get(key):
+                    live.append((self._live[key][0], i))
+                elif key not in self._masked:
+                    base_values = self._base_values(key)
+                    if base_values:
+                        values[i] = base_values[0]
+            for entry, i in sorted(live):
+                values[i] = self._read(*entry)
+        return values
+
+    def _encode(self, val):
+        val = self.serializer.dumps(val)
+        return val.encode() if isinstance(val, str) else val
+
+    def keys(self, level=None):
+        with self._lock:
+            keys = {key for key in self._base_keys() if key not in self._masked}
+            keys.update(key for key, entries in self._live.items() if entries)
+        return list(keys)
+
+    def append_val(self, key, val):
+        val = self._encode(val)
+        if self.bucket_limit and (val in self._raw_values(key) or not self._admit(key)):
+            return
+        self._append_record(self.APPEND, key, val)
+
+    def get_list(self, key, level=None, limit=None):
+        return [_as_value(self.serializer.loads(value)) for value in self.get_raw_list(key, level, limit)]
+
+    def get_raw_list(self, key, level=None, limit=None):
+        values = self._raw_values(key)
+        if limit is not None and limit < len(values):
+            values = random.sample(values, limit)
+        return values
+
+    def bucket_size(self, key):
+        return len(self._raw_values(key))
+
+    def remove_random_val(self, key):
+        values = self._raw_values(key)
+        if values:
+            self._append_record(self.DELETE_VALUE, key, random.choice(values))
+
+    def pop_list(self, key):
+        with self._lock:
+            values = self.get_list(key)
+            self._append_record(self.DELETE_KEY, key)
+        return values
+
+    def mark_split(self, key):
+        with open(os.path.join(self.path, f"{self.prefix}.split"), "a") as f:
+            f.write(key + "\n")
+        super().mark_split(key)
+
+    def _records_storage(self):
+        """ The records are stored in their own segments, keyed by id. """
+        if self._records_segments is None:
+            self._records_segments = SegmentStorage(self.config, self.prefix[1:] + "r")
+        return self._records_segments
+
+    def set_records(self, records):
+        storage = self._records_storage()
+        for record_id, val in records.items():
+            if not storage._live.get(record_id) and storage._base_entry(record_id) is None:
+                storage.append_val(record_id, val)
+
+    def get_records(self, ids):
+        values = self._records_storage()._first_raw_values(ids)
+        return [None if value is None else _as_value(self.serializer.loads(value)) for value in values]
+
+    def _start_merge(self):
+        if not self.config["background_merge"]:
+            self._merge_sealed()
+        elif self._merge_thread is None or not self._merge_thread.is_alive():
+            self._merge_thread = threading.Thread(target=self._merge_sealed, daemon=True)
+            self._merge_thread.start()
+
+    def merge(self):
+        """ Merge all the segments into the base segment. """
+        if self._records_segments is not None:
+            self._records_segments.merge()
+        self.wait()
+        with self._lock:
+            if self._active_size:
+                self._seal()
+        self._merge_sealed()
+
+    def wait(self):
+        """ Wait for the end of the running background merge, if any. """
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+    def _merge_sealed(self):
+        with self._merge_lock:
+            with self._lock:
+                segments = list(self._sealed)
+                base, directory = self._base, self._directory
+            if not segments:
+                return
+            # the operations of the sealed segments, by key
+            operations = {}
+            for seq in segments:
+                with open(self._file(seq, "seg"), "rb") as f:
+                    data = f.read()
+                for record_type, key, _, value in self._records(data):
+                    operations.setdefault(key, []).append((record_type, value))
+
+            last_seq = segments[-1]
+            entries = []
+            with open(self._file(last_seq, "base.tmp"), "wb") as f:
+                offset = 0
+                for key in sorted(set(self._base_keys()).union(operations)):
+                    values = dict.fromkeys(self._base_values(key))
+                    for record_type, value in operations.get(key, ()):
+                        if record_type == self.APPEND:
+                            values[value] = None
+                        elif record_type == self.DELETE_KEY:
+                            values.clear()
+                        else:
+                            values.pop(value, None)
+                    if not values:
+                        continue
+                    raw_key = key.encode("ascii")
+                    run = b"".join(self.RECORD.pack(self.APPEND, len(raw_key), len(value)) + raw_key + value
+                                   for value in values)
+                    f.write(run)
+                    entries.append((raw_key, offset, len(run), len(values)))
+                    offset += len(run)
+                self._write_out(f)
+            key_width = max((len(entry[0]) for entry in entries), default=0)
+            with open(self._file(last_seq, "dir.tmp"), "wb") as f:
+                f.write(self.DIRECTORY_HEADER.pack(self.DIRECTORY_MAGIC, self.DIRECTORY_VERSION,
+                                                   key_width, len(entries)))
+                for raw_key, offset, size, count in entries:
+                    f.write(raw_key.ljust(key_width, b"\0") + self.DIRECTORY_ENTRY.pack(offset, size, count))
+                self._write_out(f)
+            # the directory is renamed last, a base segment without directory is ignored
+            os.replace(self._file(last_seq, "base.tmp"), self._file(last_seq, "base"))
+            os.replace(self._file(last_seq, "dir.tmp"), self._file(last_seq, "dir"))
+
+            with self._lock:
+                old_seq = self._base_seq
+                self._base_seq = last_seq
+                self._base, self._directory = self._map_base(last_seq)
+                for key in list(self._live):
+                    self._live[key] = [entry for entry in self._live[key] if entry[0] > last_seq]
+                    if not self._live[key]:
+                        del self._live[key]
+                self._masked = {key: seq for key, seq in self._masked.items() if seq > last_seq}
+                for key in list(self._removed):
+                    self._removed[key] = {value: seq for value, seq in self._removed[key].items()
+                                          if seq > last_seq}
+                    if not self._removed[key]:
+                        del self._removed[key]
+                self._sealed = [seq for seq in self._sealed if seq > last_seq]
+                for seq in segments:
+                    reader = self._readers.pop(seq, None)
+                    if reader is not None:
+                        reader.close()
+                    os.remove(self._file(seq, "seg"))
+                for old_map in (base, directory):
+                    if old_map is not None:
+                        old_map.close()
+                if old_seq >= 0:
+                    os.remove(self._file(old_seq, "base"))
+                    os.remove(self._file(old_seq, "dir"))
+
+    def close(self):
+        """ Wait for the running merge, flush and close the files. """
+        if self._records_segments is not None:
+            self._records_segments.close()
+        self.wait()
+        with self._lock:
+            self._write_out(self._active)
+            self._active.close()
+            for reader in self._readers.values():
+                reader.close()
+            self._readers = {}
+            for mapped in (self._base, self._directory):
+                if mapped is not None:
+                    mapped.close()
+            self._base = self._directory = None
+
+
+# marks the threads running a scatter of a sharded storage
+_scatter_state = threading.local()
+
+
+class _HashRing(object):
+    """ Consistent hash ring mapping keys to node names.
+
+    Each node is placed `replicas` times on the ring so that adding or removing
+    a node only moves about `1 / len(nodes)` of the keys.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        ring = sorted((int(_compute_hash(f"{node}#{i}"), 16), node)
+                      for node in nodes for i in range(replicas))
+        self._points = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get(self, key):
+        position = bisect.bisect(self._points, int(_compute_hash(key), 16))
+        return self._nodes[position % len(self._points)]
+
+
+class ShardedStorage(BaseStorage):
+    def __init__(self, config, h_index):
+        """
+        config:
+            shards: list of storage configs, or dict of {shard_name: storage_config}.
+                Shard names are used for the placement, keep them stable to keep
+                the placement stable. Default names are 'shard-0', 'shard-1', ...
+            placement: 'table'|'key'|'value', default: 'key'
+                'table': each hash table lives on a single shard
+                'key': each bucket lives on a single shard
+                'value': each bucket is partitioned over all the shards, queries
+                    are scattered to every shard and the partial results merged
+            replicas: number of points per shard on the hash ring, default: 64
+            workers: number of threads used to scatter requests, default: number of shards
+
+        The bucket options (see :class:`BaseStorage`) are set in the configuration
+        of each shard.
+        """
+        super().__init__()
+        self.name = "sharded"
+        self.config = {
+            "shards": None,
+            "placement": "key",
+            "replicas": 64,
+            "workers": None,
+        }
+        self.config.update(config or {})
+        shards = self.config["shards"]
+        if not shards:
+            raise ValueError("At least one shard needs to be configured.")
+        if not isinstance(shards, dict):
+            shards = {f"shard-{i}": shard_config for i, shard_config in enumerate(shards)}
+        if self.placement not in ("table", "key", "value"):
+            raise ValueError("The placement should be one of 'table', 'key' or 'value'.")
+        self.shards = {name: storage(shard_config, h_index) for name, shard_config in shards.items()}
+        self._ring = _HashRing(sorted(self.shards), self.config["replicas"])
+        self._table_shard = self.shards[self._ring.get(str(h_index))]
+        self._executor = None
+
+    @property
+    def placement(self):
+        return self.config["placement"]
+
+    def _shard_for(self, key):
+        return self.shards[self._ring.get(key)]
+
+    def _shard_for_value(self, val):
+        return self._shard_for(repr(val))
+
+    def scatter(self, func, shards=None):
+        """ Call `func(shard)` on each shard in parallel and return the list of
+        the results. """
+        if shards is None:
+            shards = list(self.shards.values())
+        if len(shards) == 1 or getattr(_scatter_state, "active", False):
+            # a scatter from a scatter worker would wait for the busy workers
+            return [func(shard) for shard in shards]
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            workers = self.config["workers"] or len(self.shards)
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        def run(shard):
+            _scatter_state.active = True
+            try:
+                return func(shard)
+            finally:
+                _scatter_state.active = False
+        return list(self._executor.map(run, shards))
+
+    def target_shards(self, key):
+        """ Returns the shards holding (part of) the bucket stored at `key`. """
+        if self.placement == "table":
+            return [self._table_shard]
+        elif self.placement == "key":
+            return [self._shard_for(key)]
+        else:
+            return list(self.shards.values())
+
+    def keys(self, level=None):
+        if self.placement == "table":
+            return self._table_shard.keys(level=level)
+        result = set()
+        for shard_keys in self.scatter(lambda shard: shard.keys(level=level)):
+            result.update(shard_keys)
+        return list(result)
+
+    def append_val(self, key, val):
+        if self.placement == "value":
+            shard = self._shard_for_value(val)
+        else:
+            shard = self.target_shards(key)[0]
+        shard.append_val(key, val)
+
+    def get_list(self, key, level=None, limit=None):
+        result = []
+        for partial in self.get_partial_lists(key, level, limit):
+            result.extend(partial)
+        return result
+
+    def get_raw_list(self, key, level=None, limit=None):
+        result = []
+        for partial in self.get_partial_lists(key, level, limit, raw=True):
+            result.extend(partial)
+        return result
+
+    def get_partial_lists(self, key, level=None, limit=None, raw=False):
+        """ Returns the list stored at `key` as one partial list per shard.
+
+        If `limit` is set, it is spread evenly over the shards. If `raw` is
+        set, the values are returned serialized, see :meth:`get_raw_list`.
+        """
+        shards = self.target_shards(key)
+        method = "get_raw_list" if raw else "get_list"
+        if limit is None:
+            return self.scatter(lambda shard: getattr(shard, method)(key, level), shards)
+        limits = self.shard_limits(limit, len(shards))
+        return self.scatter(lambda item: getattr(item[0], method)(key, level, item[1]), list(zip(shards, limits)))
+
+    @property
+    def codec(self):
+        codecs = [shard.codec for shard in self.shards.values()]
+        return codecs[0] if all(codecs) else None
+
+    @staticmethod
+    def shard_limits(limit, num_shards):
+        """ Spread `limit` over `num_shards` shards, the first `limit %
+        num_shards` shards getting one more value than the others. """
+        share, remainder = divmod(limit, num_shards)
+        return [share + 1 if i < remainder else share for i in range(num_shards)]
+
+    @property
+    def max_split_bits(self):
+        return min(shard.max_split_bits for shard in self.shards.values())
+
+    def bucket_size(self, key):
+        return sum(self.scatter(lambda shard: shard.bucket_size(key), self.target_shards(key)))
+
+    def pop_list(self, key):
+        result = []
+        for partial in self.scatter(lambda shard: shard.pop_list(key), self.target_shards(key)):
+            result.extend(partial)
+        return result
+
+    def is_overfull(self, key):
+        return any(shard.is_overfull(key) for shard in self.target_shards(key))
+
+    def is_split(self, key):
+        return any(shard.is_split(key) for shard in self.target_shards(key))
+
+    def mark_split(self, key):
+        for shard in self.target_shards(key):
+            shard.mark_split(key)
+
+    def migrate(self):
+        self.scatter(lambda shard: shard.migrate())
+
+    def flush(self):
+        self.scatter(lambda shard: shard.flush())
+
+    def close(self):
+        self.scatter(lambda shard: shard.close())
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def set_records(self, records):
+        # the records are placed by id
+        by_shard = {}
+        for record_id, val in records.items():
+            by_shard.setdefault(self._ring.get(record_id), {})[record_id] = val
+        for name, shard_records in by_shard.items():
+            self.shards[name].set_records(shard_records)
+
+    def get_records(self, ids):
+        ids = list(ids)
+        by_shard = {}
+        for record_id in ids:
+            by_shard.setdefault(self._ring.get(record_id), []).append(record_id)
+        names = list(by_shard)
+        values = {}
+        for name, shard_values in zip(names, self.scatter(lambda name: self.shards[name].get_records(by_shard[name]),
+                                                          names)):
+            values.update(zip(by_shard[name], shard_values))
+        return [values.get(record_id) for record_id in ids]
+
+
+def _value_size(val):
+    """ Returns the estimated memory size in bytes of the value `val`, as
+    stored by :meth:`LSHash.index`. """
+    if isinstance(val, str):
+        return sys.getsizeof(val)
+    if len(val) == 2 and isinstance(val[0], tuple):
+        return sys.getsizeof(val) + _value_size(val[0]) + sys.getsizeof(val[1])
+    # a tuple of floats
+    return sys.getsizeof(val) + len(val) * sys.getsizeof(0.0)
+
+
+class TieredStorage(BaseStorage):
+    def __init__(self, config, h_index):
+        """
+        config:
+            lower: storage config of the lower tier, holding all the buckets,
+                default: {'sqlite': {}}
+            memory_budget: max estimated size in bytes of the buckets kept in
+                memory, default: 64 MiB
+            policy: 'lru'|'lfu', the buckets evicted from memory are the least
+                recently used, or the least frequently used ones, default: 'lru'
+
+        The buckets are read from memory if they are there, and promoted to
+        memory from the lower tier otherwise. The values are written through to
+        the lower tier. Only the buckets of the default level are kept in
+        memory.
+
+        The bucket options (see :class:`BaseStorage`) are set in the
+        configuration of the lower tier.
+        """
+        super().__init__()
+        self.name = "tiered"
+        self.config = {
+            "lower": None,
+            "memory_budget": 64 * 2 ** 20,
+            "policy": "lru",
+        }
+        self.config.update(config or {})
+        if self.policy not in ("lru", "lfu"):
+            raise ValueError("The policy should be either 'lru' or 'lfu'.")
+        self.lower = storage(self.config["lower"] or {"sqlite": {}}, h_index)
+        # the buckets kept in memory, as `{key: set of values}`, in the order
+        # they were last used
+        self._hot = OrderedDict()
+        self._hot_size = 0
+        self._sizes = {}
+        # the access counts of the buckets in memory, and the heap of their
+        # `(count, order, key)`, updated lazily, for the 'lfu' policy
+        self._counts = {}
+        self._heap = []
+        self._order = 0
+        # the `[version, readers]` of the buckets being read from the lower
+        # tier, the version being bumped when the bucket is written meanwhile
+        self._reading = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.evictions = 0
+
+    @property
+    def policy(self):
+        return self.config["policy"]
+
+    @property
+    def memory_budget(self):
+        return self.config["memory_budget"]
+
+    @property
+    def hit_rate(self):
+        """ The part of the bucket reads served from memory. """
+        reads = self.hits + self.misses
+        return self.hits / reads if reads else 0.0
+
+    def metrics(self):
+        """ Returns the counters of the memory tier, to size `memory_budget`. """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+                "promotions": self.promotions,
+                "evictions": self.evictions,
+                "buckets": len(self._hot),
+                "memory_size": self._hot_size,
+            }
+
+    def _touch(self, key):
+        if self.policy == "lru":
+            self._hot.move_to_end(key)
+            return
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self._order += 1
+        heapq.heappush(self._heap, (self._counts[key], self._order, key))
+        if len(self._heap) > 4 * len(self._hot) + 64:
+            # drop the outdated entries
+            self._heap = [(count, order, k) for count, order, k in self._heap if self._counts.get(k) == count]
+            heapq.heapify(self._heap)
+
+    def _evict_one(self):
+        if self.policy == "lru":
+            key = next(iter(self._hot))
+        else:
+            while True:
+                count, _, key = heapq.heappop(self._heap)
+                if self._counts.get(key) == count:
+                    break
+        self._discard(key)
+        self.evictions += 1
+
+    def _discard(self, key):
+        if key in self._hot:
+            del self._hot[key]
+            self._hot_size -= self._sizes.pop(key)
+            self._counts.pop(key, None)
+
+    def _evict(self):
+        while self._hot_size > self.memory_budget:
+            self._evict_one()
+
+    def _promote(self, key, values):
+        if not values:
+            # the empty buckets are not worth their memory
+            return
+        size = sys.getsizeof(key) + sys.getsizeof(set()) + sum(_value_size(val) for val in values)
+        if size > self.memory_budget:
+            return
+        self._hot[key] = set(values)
+        self._sizes[key] = size
+        self._hot_size += size
+        self._touch(key)
+        self.promotions += 1
+        self._evict()
+
+    def _get_hot(self, key):
+        """ Returns the values of the bucket stored at `key`, read from memory
+        or promoted to memory. """
+        with self._lock:
+            if key in self._hot:
+                self.hits += 1
+                self._touch(key)
+                return list(self._hot[key])
+            self.misses += 1
+            state = self._reading.setdefault(key, [0, 0])
+            state[1] += 1
+            version = state[0]
+        # the lower tier is read without blocking the reads from memory
+        values = None
+        try:
+            values = self.lower.get_list(key)
+        finally:
+            with self._lock:
+                state[1] -= 1
+                if not state[1]:
+                    del self._reading[key]
+                # a bucket written during the read may miss the new values
+                if values is not None and state[0] == version and key not in self._hot:
+                    self._promote(key, values)
+        return values
+
+    def _written(self, key):
+        """ Records that the bucket stored at `key` was written to the lower
+        tier, to be called with the lock held. """
+        state = self._reading.get(key)
+        if state is not None:
+            state[0] += 1
+
+    def keys(self, level=None):
+        return self.lower.keys(level=level)
+
+    def append_val(self, key, val):
+        self.lower.append_val(key, val)
+        with self._lock:
+            self._written(key)
+            if key not in self._hot:
+                return
+            if self.lower.bucket_limit:
+                # the lower tier may have dropped a value to make room for it
+                self._discard(key)
+            elif val not in self._hot[key]:
+                self._hot[key].add(val)
+                size = _value_size(val)
+                self._sizes[key] += size
+                self._hot_size += size
+                self._evict()
+
+    def get_list(self, key, level=None, limit=None):
+        if level is not None and level != Levels.High:
+            return self.lower.get_list(key, level, limit)
+        values = self._get_hot(key)
+        if limit is not None and limit < len(values):
+            return random.sample(values, limit)
+        return values
+
+    def bucket_size(self, key):
+        with self._lock:
+            if key in self._hot:
+                return len(self._hot[key])
+        return self.lower.bucket_size(key)
+
+    def remove_random_val(self, key):
+        self.lower.remove_random_val(key)
+        with self._lock:
+            self._written(key)
+            self._discard(key)
+
+    def pop_list(self, key):
+        values = self.lower.pop_list(key)
+        with self._lock:
+            self._written(key)
+            self._discard(key)
+        return values
+
+    @property
+    def bucket_limit(self):
+        return self.lower.bucket_limit
+
+    @property
+    def max_split_bits(self):
+        return self.lower.max_split_bits
+
+    def is_overfull(self, key):
+        return self.lower.is_overfull(key)
+
+    def is_split(self, key):
+        return self.lower.is_split(key)
+
+    def mark_split(self, key):
+        self.lower.mark_split(key)
+
+    def migrate(self):
+        self.lower.migrate()
+
+    def flush(self):
+        self.lower.flush()
+
+    def close(self):
+        self.lower.close()
+
+    def set_records(self, records):
+        self.lower.set_records(records)
+
+    def get_records(self, ids):
+        return self.lower.get_records(ids)
+
+
+register_storage("dict", InMemoryStorage)
+register_storage("redis", RedisStorage)
+register_storage("sqlite", SQLiteStorage)
+register_storage("sharded", ShardedStorage)
+register_storage("segment", SegmentStorage)
+register_storage("tiered", TieredStorage)
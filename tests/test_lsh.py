@@ -1,5 +1,9 @@
 import random
 import string
+import subprocess
+import tempfile
+import threading
+import numpy as np
 from unittest import TestCase
 from unittest.mock import patch
 from fakeredis import FakeStrictRedis, FakeRedis
@@ -11,6 +15,7 @@ import os
 sys.path.insert(0, os.path.abspath('../'))
 # now we can use our lshash package and not the standard one
 from lshash import LSHash, MultiLevelLSHash
+from lshash.storage import BinaryCodec, InMemoryStorage, register_storage, storage
 
 NB_ELEMENTS = 100
 HASH_SIZE = 16
@@ -74,6 +79,119 @@ class TestLSHash(TestCase):
             self.assertEqual(el_dist, 0)
         del lsh
 
+    def test_vectorized_distances(self):
+        lsh = LSHash(self.hash_size, self.input_dim, 1)
+        query_point, ys = np.array(self.els[0]), np.array(self.els[1:])
+        scalar_funcs = {"euclidean": LSHash.euclidean_dist_square,
+                        "true_euclidean": LSHash.euclidean_dist,
+                        "centred_euclidean": LSHash.euclidean_dist_centred,
+                        "cosine": LSHash.cosine_dist,
+                        "l1norm": LSHash.l1norm_dist}
+        for distance_func, scalar_func in scalar_funcs.items():
+            d_func = lsh._get_distance_func(distance_func, list(query_point))
+            expected = [scalar_func(query_point, y) for y in ys]
+            np.testing.assert_allclose(d_func(ys), expected, rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(d_func(ys, BinaryCodec.stats(ys)), expected, rtol=1e-9, atol=1e-12)
+
+    def test_all_pairs(self):
+        lsh = LSHash(8, self.input_dim, 3)
+        # near-duplicates of the first points
+        els = [list(el) for el in self.els] + [list(np.add(el, 1e-3)) for el in self.els[:10]]
+        for el in els:
+            lsh.index(el)
+        threshold = 0.5
+        expected = set()
+        for i, table in enumerate(lsh.hash_tables):
+            for key in table.keys():
+                points = table.get_list(key)
+                for a in points:
+                    for b in points:
+                        if a != b and LSHash.euclidean_dist_square(a, np.array(b)) <= threshold:
+                            expected.add(frozenset((a, b)))
+        self.assertGreaterEqual(len(expected), 10)
+        for workers in (None, 2):
+            pairs = list(lsh.all_pairs(threshold, workers=workers))
+            self.assertEqual(len(pairs), len(expected))
+            self.assertEqual({frozenset((a, b)) for a, b, _ in pairs}, expected)
+            for a, b, distance in pairs:
+                self.assertAlmostEqual(distance, LSHash.euclidean_dist_square(a, np.array(b)))
+        cosine_pairs = list(lsh.all_pairs(1e-4, distance_func="cosine"))
+        self.assertGreaterEqual(len(cosine_pairs), 10)
+        self.assertTrue(all(distance <= 1e-4 for _, _, distance in cosine_pairs))
+
+    def test_all_pairs_distances(self):
+        lsh = LSHash(1, self.input_dim)
+        # near-duplicates, and multiples for the cosine distance
+        els = np.array(self.els[:20])
+        els = np.vstack([els, els[:5] + 1e-6, els[:5] * 3])
+        for el in els:
+            lsh.index(list(el))
+        for distance_func, thresholds in (("euclidean", (0, 1e-9, 10)), ("true_euclidean", (0, 1e-5, 3)),
+                                          ("centred_euclidean", (0, 1e-3)), ("cosine", (0, 1e-9, 0.1)),
+                                          ("l1norm", (0, 1e-4, 30)), ("hamming", (0, 10))):
+            for threshold in thresholds:
+                # the distances of the points of each bucket to each other
+                expected = set()
+                for key in lsh.hash_tables[0].keys():
+                    points = lsh.hash_tables[0].get_list(key)
+                    for i, point in enumerate(points[:-1]):
+                        d_func = lsh._get_distance_func(distance_func, point)
+                        for other, distance in zip(points[i + 1:], d_func(np.array(points[i + 1:]))):
+                            if distance <= threshold:
+                                expected.add((frozenset((point, other)), distance))
+                pairs = {(frozenset((a, b)), distance)
+                         for a, b, distance in lsh.all_pairs(threshold, distance_func=distance_func)}
+                self.assertEqual(pairs, expected)
+        self.assertRaises(ValueError, list, lsh.all_pairs(1, distance_func="invalid"))
+
+    def test_fit(self):
+        # offset points, hashed into a few buckets by the random planes
+        els = np.array(self.els[:50]) + 3
+        with tempfile.TemporaryDirectory() as tmpdir:
+            matrices_filename = os.path.join(tmpdir, "planes.npz")
+            for method in ("itq", "pca", "median"):
+                lsh = LSHash(4, self.input_dim, 2, matrices_filename=matrices_filename, overwrite=True)
+                lsh.fit(els, method)
+                self.assertEqual(lsh.uniform_planes[0].shape, (4, self.input_dim + 1))
+                for el in els:
+                    lsh.index(list(el))
+                for table in lsh.hash_tables:
+                    sizes = [len(table.get_list(key)) for key in table.keys()]
+                    # each bit splits the sample evenly
+                    self.assertGreaterEqual(len(sizes), 4)
+                    self.assertLess(max(sizes), len(els) / 2)
+                for el in els[:10]:
+                    self.assertEqual(lsh.query(list(el), num_results=1)[0][1], 0)
+                self.assertRaises(ValueError, lsh.fit, els, method)
+                reloaded = LSHash(4, self.input_dim, 2, matrices_filename=matrices_filename)
+                self.assertEqual(reloaded.hash(list(els[0])), lsh.hash(list(els[0])))
+        lsh = LSHash(self.input_dim + 1, self.input_dim, 1)
+        self.assertRaises(ValueError, lsh.fit, els, "itq")
+        lsh.fit(els, "median")
+
+    def test_lshash_query_iter(self):
+        lsh = LSHash(4, self.input_dim, 3)
+        for i in range(self.nb_elements):
+            lsh.index(list(self.els[i]), self.el_names[i])
+        for distance_func in ("euclidean", "cosine", "hamming"):
+            for el in self.els[:10]:
+                res = lsh.query(list(el), distance_func=distance_func)
+                self.assertEqual(list(lsh.query_iter(list(el), distance_func=distance_func)), res)
+                top = list(lsh.query_iter(list(el), num_results=3, distance_func=distance_func))
+                self.assertEqual(len(top), 3)
+                self.assertEqual(top, sorted(top, key=lambda x: x[1]))
+                self.assertEqual(top[0], res[0])
+
+    def test_lshash_query_radius(self):
+        lsh = LSHash(4, self.input_dim, 2)
+        for i in range(self.nb_elements):
+            lsh.index(list(self.els[i]))
+        for el in self.els[:10]:
+            res = lsh.query(list(el))
+            radius = res[len(res) // 2][1]
+            self.assertEqual(lsh.query_radius(list(el), radius), [r for r in res if r[1] <= radius])
+
+
 class TestLSHashSQLite(TestCase):
     nb_elements = NB_ELEMENTS
     hash_size = HASH_SIZE
@@ -131,6 +249,10 @@ class TestLSHashRedis(TestCase):
     els = ELEMENTS
     el_names = ELEMENTS_NAMES
 
+    def setUp(self):
+        # fakeredis instances connected to the same db share their data
+        FakeStrictRedis(host='localhost', port=6379, db=15).flushdb()
+
     def test_lshash_redis(self):
         """
         Test external lshash module
@@ -184,6 +306,628 @@ class TestLSHashRedis(TestCase):
         del lsh
 
 
+@patch('redis.StrictRedis', FakeStrictRedis)
+class TestLSHashSharded(TestCase):
+    nb_elements = NB_ELEMENTS
+    hash_size = HASH_SIZE
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+    el_names = ELEMENTS_NAMES
+
+    def setUp(self):
+        for db in range(3):
+            FakeStrictRedis(host='localhost', port=6379, db=db).flushdb()
+
+    def _check_lshash(self, lsh):
+        for i in range(self.nb_elements):
+            lsh.index(list(self.els[i]), self.el_names[i])
+        for el in self.els:
+            res = lsh.query(list(el), num_results=1, distance_func='euclidean')[0]
+            (el_v, el_name), el_dist = res
+            self.assertIn(el_v, self.els)
+            self.assertIn(el_name, self.el_names)
+            self.assertEqual(el_dist, 0)
+        for i in range(0, self.nb_elements, 10):
+            el = list(self.els[i])
+            self.assertEqual(lsh.query(el, num_results=3), lsh.query(el)[:3])
+
+    def test_lshash_sharded_redis(self):
+        for placement in ("table", "key", "value"):
+            self.setUp()
+            shards = [{"redis": {"host": 'localhost', "port": 6379, "db": db}} for db in range(3)]
+            config = {"sharded": {"shards": shards, "placement": placement}}
+            lsh = LSHash(self.hash_size, self.input_dim, 2, config)
+            self._check_lshash(lsh)
+            sizes = [FakeStrictRedis(host='localhost', port=6379, db=db).dbsize() for db in range(3)]
+            # with a 'table' placement, 2 hash tables cannot use more than 2 shards
+            self.assertGreaterEqual(sum(map(bool, sizes)), 2, sizes)
+
+    def test_lshash_sharded_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shards = {f"node{i}": {"sqlite": {"database": os.path.join(tmpdir, f"node{i}.db")}}
+                      for i in range(3)}
+            config = {"sharded": {"shards": shards, "placement": "value"}}
+            lsh = LSHash(self.hash_size, self.input_dim, 2, config)
+            self._check_lshash(lsh)
+            table = lsh.hash_tables[0]
+            for key in table.keys():
+                partials = table.get_partial_lists(key)
+                self.assertEqual(len(partials), 3)
+                self.assertEqual(sum(map(len, partials)), len(table.get_list(key)))
+                self.assertLessEqual(len(table.get_list(key, limit=4)), 4)
+            for el in self.els[:10]:
+                self.assertLessEqual(len(lsh.query(list(el), candidate_budget=5)), 5)
+
+    def test_sharded_sqlite_threads(self):
+        shards = [{"sqlite": {"serializer": "binary"}} for _ in range(3)]
+        lsh = LSHash(self.hash_size, self.input_dim, 2, {"sharded": {"shards": shards, "placement": "value"}})
+
+        def index(start):
+            for i in range(start, self.nb_elements, 4):
+                lsh.index(list(self.els[i]), self.el_names[i])
+                lsh.query(list(self.els[i]), num_results=1)
+        threads = [threading.Thread(target=index, args=(start,)) for start in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for table in lsh.hash_tables:
+            self.assertEqual(sum(len(table.get_list(key)) for key in table.keys()), self.nb_elements)
+        executors = [table._executor for table in lsh.hash_tables]
+        lsh.close()
+        for table, executor in zip(lsh.hash_tables, executors):
+            self.assertIsNone(table._executor)
+            self.assertRaises(RuntimeError, executor.submit, print)
+
+    def test_sharded_budget_hamming(self):
+        shards = [{"dict": None} for _ in range(3)]
+        lsh = LSHash(4, self.input_dim, 3, {"sharded": {"shards": shards, "placement": "value"}})
+        for el, name in zip(self.els, self.el_names):
+            lsh.index(list(el), name)
+        for el in self.els[:10]:
+            # each bucket is charged the values it returned, the rest of the
+            # budget is left to the next buckets and hash tables
+            res = lsh.query(list(el), num_results=self.nb_elements, distance_func="hamming",
+                            candidate_budget=3 * self.nb_elements)
+            self.assertEqual(res, lsh.query(list(el), num_results=self.nb_elements, distance_func="hamming"))
+
+
+@patch('redis.StrictRedis', FakeStrictRedis)
+class TestLSHashBucketLimits(TestCase):
+    nb_elements = NB_ELEMENTS
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+    el_names = ELEMENTS_NAMES
+    # a small hash size makes large buckets
+    hash_size = 2
+    bucket_limit = 10
+
+    def setUp(self):
+        FakeStrictRedis(host='localhost', port=6379, db=15).flushdb()
+
+    def _configs(self, bucket_overflow):
+        options = {"bucket_limit": self.bucket_limit, "bucket_overflow": bucket_overflow}
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        return [
+            {"dict": dict(options)},
+            {"sqlite": dict(options)},
+            {"redis": dict(options, host='localhost', port=6379, db=15)},
+            {"segment": dict(options, path=tmpdir.name, segment_size=4096, background_merge=False)},
+            {"tiered": {"lower": {"sqlite": dict(options)}, "memory_budget": 20000}},
+        ]
+
+    def test_reservoir(self):
+        for config in self._configs("reservoir"):
+            self.setUp()
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config)
+            for i in range(self.nb_elements):
+                lsh.index(list(self.els[i]), self.el_names[i])
+                lsh.index(list(self.els[i]), self.el_names[i])  # multiple insertions
+            hasht = lsh.hash_tables[0]
+            itms = [hasht.get_list(k) for k in hasht.keys()]
+            self.assertLessEqual(max(map(len, itms)), self.bucket_limit, config)
+            for itm in itms:
+                self.assertEqual(len(set(itm)), len(itm))
+                for el in itm:
+                    self.assertIn(el[0], self.els)
+
+    def test_split(self):
+        for config in self._configs("split"):
+            self.setUp()
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config)
+            for i in range(self.nb_elements):
+                lsh.index(list(self.els[i]), self.el_names[i])
+            hasht = lsh.hash_tables[0]
+            itms = [hasht.get_list(k) for k in hasht.keys()]
+            self.assertLessEqual(max(map(len, itms)), self.bucket_limit, config)
+            self.assertEqual(sum(map(len, itms)), self.nb_elements)
+            self.assertTrue(any(len(key) > self.hash_size for key in hasht.keys()))
+            for el in self.els:
+                (el_v, el_name), el_dist = lsh.query(list(el), num_results=1)[0]
+                self.assertEqual(el_v, el)
+                self.assertEqual(el_dist, 0)
+
+    def test_split_persistence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"sqlite": {"database": os.path.join(tmpdir, "lshash.db"),
+                                 "bucket_limit": self.bucket_limit, "bucket_overflow": "split"}}
+            matrices_filename = os.path.join(tmpdir, "planes.npz")
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            for i in range(self.nb_elements):
+                lsh.index(list(self.els[i]))
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            for el in self.els:
+                el_v, el_dist = lsh.query(list(el), num_results=1)[0]
+                self.assertEqual(el_v, el)
+
+    def test_candidate_budget(self):
+        lsh = LSHash(self.hash_size, self.input_dim, 3)
+        for i in range(self.nb_elements):
+            lsh.index(list(self.els[i]))
+        for el in self.els[:10]:
+            self.assertLessEqual(len(lsh.query(list(el), candidate_budget=15)), 15)
+            res = lsh.query(list(el), num_results=1, candidate_budget=self.nb_elements * 3)
+            self.assertEqual(res, lsh.query(list(el), num_results=1))
+
+
+class TestLSHashTiered(TestCase):
+    nb_elements = NB_ELEMENTS
+    hash_size = 4
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+    el_names = ELEMENTS_NAMES
+
+    def test_tiered(self):
+        value_sizes = {"inline": sys.getsizeof(self.els[0]) + self.input_dim * sys.getsizeof(0.0),
+                       "ids": sys.getsizeof("0" * 40)}
+        for policy in ("lru", "lfu"):
+            for storage_layout, value_size in value_sizes.items():
+                # room in memory for about a third of the points
+                config = {"tiered": {"lower": {"sqlite": {}}, "policy": policy,
+                                     "memory_budget": value_size * self.nb_elements // 3}}
+                lsh = LSHash(self.hash_size, self.input_dim, 1, config, storage_layout=storage_layout)
+                for el, name in zip(self.els, self.el_names):
+                    lsh.index(list(el), name)
+                for _ in range(2):
+                    for el, name in zip(self.els, self.el_names):
+                        (el_v, el_name), el_dist = lsh.query(list(el), num_results=1)[0]
+                        self.assertEqual((el_v, el_name), (el, name))
+                        self.assertEqual(el_dist, 0)
+                hasht = lsh.hash_tables[0]
+                metrics = hasht.metrics()
+                self.assertEqual(metrics["hits"] + metrics["misses"], 2 * self.nb_elements)
+                self.assertGreater(metrics["hits"], 0)
+                self.assertGreater(metrics["evictions"], 0)
+                self.assertLessEqual(metrics["memory_size"], hasht.memory_budget)
+                self.assertAlmostEqual(hasht.hit_rate, metrics["hits"] / (2 * self.nb_elements))
+                # the values are written through to the buckets in memory
+                key = next(iter(hasht._hot))
+                size = hasht.bucket_size(key)
+                hasht.append_val(key, (tuple(self.els[0]), "new"))
+                self.assertEqual(hasht.bucket_size(key), size + 1)
+                self.assertEqual(sorted(map(repr, hasht.get_list(key))),
+                                 sorted(map(repr, hasht.lower.get_list(key))))
+        self.assertRaises(ValueError, LSHash, self.hash_size, self.input_dim, 1, {"tiered": {"policy": "fifo"}})
+
+    def test_tiered_empty_buckets(self):
+        hasht = storage({"tiered": {"lower": {"sqlite": {}}, "memory_budget": 10000}}, 0)
+        for i in range(100):
+            self.assertEqual(hasht.get_list(f"missing{i}"), [])
+        self.assertEqual(hasht.metrics()["buckets"], 0)
+        hasht.append_val("key", tuple(self.els[0]))
+        hasht.get_list("key")
+        self.assertGreater(hasht.metrics()["memory_size"], 0)
+
+    def test_tiered_concurrent_read(self):
+        hasht = storage({"tiered": {"lower": {"sqlite": {}}}}, 0)
+        hot, cold = tuple(self.els[0]), tuple(self.els[1])
+        hasht.append_val("hot", hot)
+        hasht.append_val("cold", cold)
+        hasht.get_list("hot")
+        reading, release = threading.Event(), threading.Event()
+        lower_get_list = hasht.lower.get_list
+
+        def slow_get_list(key, *args, **kwargs):
+            values = lower_get_list(key, *args, **kwargs)
+            if key == "cold":
+                reading.set()
+                release.wait(10)
+            return values
+        hasht.lower.get_list = slow_get_list
+        reader = threading.Thread(target=hasht.get_list, args=("cold",))
+        reader.start()
+        self.assertTrue(reading.wait(10))
+        # the reads from memory are not blocked by the read from the lower tier
+        self.assertEqual(hasht.get_list("hot"), [hot])
+        # written during the read, the bucket is not promoted without the value
+        hasht.append_val("cold", hot)
+        release.set()
+        reader.join(10)
+        self.assertEqual(sorted(hasht.get_list("cold")), sorted([hot, cold]))
+        self.assertEqual(sorted(hasht.get_list("cold")), sorted([hot, cold]))
+
+
+class TestLSHashRebuild(TestCase):
+    nb_elements = NB_ELEMENTS
+    hash_size = HASH_SIZE
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+    el_names = ELEMENTS_NAMES
+
+    def _check_indexed(self, lsh, els, names):
+        for el, name in zip(els, names):
+            (el_v, el_name), el_dist = lsh.query(list(el), num_results=1)[0]
+            self.assertEqual((el_v, el_name), (tuple(el), name))
+            self.assertEqual(el_dist, 0)
+
+    def test_rebuild(self):
+        for storage_layout in ("inline", "ids"):
+            lsh = LSHash(self.hash_size, self.input_dim, 1, storage_layout=storage_layout)
+            for el, name in zip(self.els, self.el_names):
+                lsh.index(list(el), name)
+            rebuild = lsh.rebuild(hash_size=8, num_hashtables=3, background=False)
+            self.assertTrue(rebuild.done)
+            self.assertEqual(rebuild.indexed, self.nb_elements)
+            self.assertEqual((lsh.hash_size, lsh.num_hashtables, lsh.table_offset), (8, 3, 1))
+            self.assertEqual(len(lsh.hash_tables), 3)
+            self.assertTrue(all(len(key) == 8 for table in lsh.hash_tables for key in table.keys()))
+            self._check_indexed(lsh, self.els, self.el_names)
+
+    def test_background_rebuild(self):
+        lsh = LSHash(self.hash_size, self.input_dim, 1)
+        half = self.nb_elements // 2
+        for el, name in zip(self.els[:half], self.el_names[:half]):
+            lsh.index(list(el), name)
+        old_tables = lsh.hash_tables
+        rebuild = lsh.rebuild(num_hashtables=2, batch_size=5, throttle=0.01)
+        self.assertRaises(ValueError, lsh.rebuild)
+        # the points indexed during the rebuild are indexed in both hash tables
+        for el, name in zip(self.els[half:], self.el_names[half:]):
+            lsh.index(list(el), name)
+            self._check_indexed(lsh, [el], [name])
+        self.assertTrue(rebuild.wait(timeout=60))
+        self.assertIsNot(lsh.hash_tables, old_tables)
+        self.assertEqual(len(lsh.hash_tables), 2)
+        self._check_indexed(lsh, self.els, self.el_names)
+
+    def test_rebuild_persistence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"sqlite": {"database": os.path.join(tmpdir, "lshash.db")}}
+            matrices_filename = os.path.join(tmpdir, "planes.npz")
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            for el, name in zip(self.els, self.el_names):
+                lsh.index(list(el), name)
+            lsh.rebuild(hash_size=4, num_hashtables=2, sample=np.array(self.els), method="pca").wait()
+            self.assertEqual(lsh.uniform_planes[0].shape, (4, self.input_dim + 1))
+            # the new hash tables are reopened from the matrices file, with
+            # the arguments of the initial index
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            self.assertEqual((lsh.hash_size, lsh.num_hashtables, lsh.table_offset), (4, 2, 1))
+            self.assertEqual(len(lsh.hash_tables), 2)
+            self._check_indexed(lsh, self.els, self.el_names)
+            self.assertRaises(ValueError, lsh.rebuild, table_offset=0)
+
+
+@patch('redis.StrictRedis', FakeStrictRedis)
+class TestLSHashSegment(TestCase):
+    nb_elements = NB_ELEMENTS
+    hash_size = HASH_SIZE
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+    el_names = ELEMENTS_NAMES
+
+    def _check_lshash(self, lsh):
+        hasht = lsh.hash_tables[0]
+        itms = [hasht.get_list(k) for k in hasht.keys()]
+        self.assertEqual(sum(map(len, itms)), self.nb_elements)
+        for itm in itms:
+            for el in itm:
+                self.assertIn(el[0], self.els)
+                self.assertIn(el[1], self.el_names)
+        for el in self.els:
+            (el_v, el_name), el_dist = lsh.query(list(el), num_results=1)[0]
+            self.assertEqual(el_v, el)
+            self.assertEqual(el_dist, 0)
+
+    def test_lshash_segment(self):
+        for background_merge in (False, True):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                config = {"segment": {"path": tmpdir, "segment_size": 4096, "merge_segments": 2,
+                                      "background_merge": background_merge}}
+                matrices_filename = os.path.join(tmpdir, "planes.npz")
+                lsh = LSHash(self.hash_size, self.input_dim, 2, config, matrices_filename)
+                for i in range(self.nb_elements):
+                    lsh.index(list(self.els[i]), self.el_names[i])
+                    lsh.index(list(self.els[i]), self.el_names[i])  # multiple insertions
+                self._check_lshash(lsh)
+                for hasht in lsh.hash_tables:
+                    hasht.wait()
+                self.assertGreaterEqual(lsh.hash_tables[0]._base_seq, 0)
+                self._check_lshash(lsh)
+                for hasht in lsh.hash_tables:
+                    hasht.close()
+                # reopen the storage from its files
+                lsh = LSHash(self.hash_size, self.input_dim, 2, config, matrices_filename)
+                self._check_lshash(lsh)
+                for hasht in lsh.hash_tables:
+                    hasht.merge()
+                    self.assertFalse(hasht._live)
+                    self.assertEqual(len([f for f in os.listdir(tmpdir) if f.startswith(hasht.prefix + "-")]), 3)
+                self._check_lshash(lsh)
+                for hasht in lsh.hash_tables:
+                    hasht.close()
+
+    def test_segment_deletes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"path": tmpdir, "background_merge": False}
+            hasht = storage({"segment": config}, 0)
+            for i in range(10):
+                hasht.append_val("01", self.els[i])
+            hasht.merge()
+            hasht.append_val("01", self.els[10])
+            self.assertEqual(hasht.bucket_size("01"), 11)
+            hasht.remove_random_val("01")
+            self.assertEqual(hasht.bucket_size("01"), 10)
+            self.assertEqual(len(hasht.pop_list("01")), 10)
+            hasht.append_val("01", self.els[11])
+            hasht.close()
+            hasht = storage({"segment": config}, 0)
+            self.assertEqual(hasht.get_list("01"), [self.els[11]])
+            hasht.merge()
+            self.assertEqual(hasht.get_list("01"), [self.els[11]])
+            self.assertEqual(hasht.keys(), ["01"])
+            hasht.close()
+
+    def test_segment_flush(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"segment": {"path": tmpdir, "background_merge": False, "sync": True}}
+            matrices_filename = os.path.join(tmpdir, "planes.npz")
+            # the process exits without closing the index
+            code = ("import os, random\n"
+                    "from lshash import LSHash\n"
+                    f"lsh = LSHash({self.hash_size}, {self.input_dim}, 1, {config!r}, {matrices_filename!r})\n"
+                    "for i in range(50):\n"
+                    f"    lsh.index([random.random() for _ in range({self.input_dim})], i + 1)\n"
+                    "lsh.flush()\n"
+                    "os._exit(0)\n")
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            subprocess.check_call([sys.executable, "-c", code], cwd=root)
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            hasht = lsh.hash_tables[0]
+            self.assertEqual(sorted(v[1] for k in hasht.keys() for v in hasht.get_list(k)), list(range(1, 51)))
+            lsh.index(list(self.els[0]), "closed")
+            lsh.close()
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            self.assertEqual(lsh.query(list(self.els[0]), num_results=1)[0][0][1], "closed")
+            lsh.close()
+
+    def test_segment_path_required(self):
+        with self.assertRaises(ValueError):
+            storage({"segment": {}}, 0)
+
+
+@patch('redis.StrictRedis', FakeStrictRedis)
+class TestLSHashIdsLayout(TestCase):
+    nb_elements = NB_ELEMENTS
+    hash_size = HASH_SIZE
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+    el_names = ELEMENTS_NAMES
+
+    def setUp(self):
+        for db in (13, 14, 15):
+            FakeStrictRedis(host='localhost', port=6379, db=db).flushdb()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def _configs(self):
+        redis_shards = [{"redis": {"host": 'localhost', "port": 6379, "db": db}} for db in (13, 14)]
+        return [
+            {"dict": None},
+            {"sqlite": {"serializer": "binary"}},
+            {"redis": {"host": 'localhost', "port": 6379, "db": 15}},
+            {"segment": {"path": self.tmpdir}},
+            {"sharded": {"shards": redis_shards, "placement": "value"}},
+            {"dict": {"bucket_limit": 10, "bucket_overflow": "split"}},
+        ]
+
+    def test_lshash_ids(self):
+        for config in self._configs():
+            lsh = LSHash(4, self.input_dim, 3, config, storage_layout="ids")
+            for i in range(self.nb_elements):
+                lsh.index(list(self.els[i]), self.el_names[i])
+                lsh.index(list(self.els[i]), self.el_names[i])  # multiple insertions
+            for hasht in lsh.hash_tables:
+                ids = [v for k in hasht.keys() for v in hasht.get_list(k)]
+                self.assertEqual(len(ids), self.nb_elements)
+                self.assertTrue(all(isinstance(v, str) for v in ids), config)
+            for el, name in zip(self.els, self.el_names):
+                (el_v, el_name), el_dist = lsh.query(list(el), num_results=1)[0]
+                np.testing.assert_allclose(el_v, el, rtol=1e-6)
+                self.assertEqual(el_name, name)
+                self.assertAlmostEqual(el_dist, 0)
+                self.assertEqual(list(lsh.query_iter(list(el), num_results=1))[0][0], (el_v, el_name))
+            if "segment" in config:
+                for hasht in lsh.hash_tables:
+                    hasht.close()
+
+    def test_records_stored_once(self):
+        config = {"redis": {"host": 'localhost', "port": 6379, "db": 15}}
+        lsh = LSHash(self.hash_size, self.input_dim, 3, config, storage_layout="ids")
+        for i in range(self.nb_elements):
+            lsh.index(list(self.els[i]), self.el_names[i])
+        self.assertEqual(lsh.record_store.storage.hlen("lshash:records"), self.nb_elements)
+        inline = LSHash(self.hash_size, self.input_dim, 3)
+        # the same planes give the same candidates
+        inline.uniform_planes = lsh.uniform_planes
+        for i in range(self.nb_elements):
+            inline.index(list(self.els[i]), self.el_names[i])
+        for el in self.els[:10]:
+            self.assertEqual(lsh.query(list(el)), inline.query(list(el)))
+
+
+@patch('redis.StrictRedis', FakeStrictRedis)
+class TestBinaryCodec(TestCase):
+    nb_elements = NB_ELEMENTS
+    hash_size = HASH_SIZE
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+    el_names = ELEMENTS_NAMES
+
+    def setUp(self):
+        FakeStrictRedis(host='localhost', port=6379, db=15).flushdb()
+
+    def test_codec(self):
+        codec = BinaryCodec()
+        blobs = [codec.dumps((el, name)) for el, name in zip(self.els, self.el_names)]
+        blobs.append(codec.dumps(self.els[0]))
+        for blob, el, name in zip(blobs, self.els, self.el_names):
+            el_v, el_name = codec.loads(blob)
+            np.testing.assert_allclose(el_v, el, rtol=1e-6)
+            self.assertEqual(el_name, name)
+        np.testing.assert_allclose(codec.loads(blobs[-1]), self.els[0], rtol=1e-6)
+        out = np.zeros((len(blobs) + 5, self.input_dim), dtype=np.float32)
+        matrix, extras = codec.loads_many(blobs, out)
+        np.testing.assert_allclose(matrix, self.els + [self.els[0]], rtol=1e-6)
+        self.assertEqual(extras, self.el_names + [None])
+        self.assertTrue(np.shares_memory(matrix, out))
+
+    def test_codec_stats(self):
+        codec = BinaryCodec()
+        blobs = [codec.dumps((el, name)) for el, name in zip(self.els, self.el_names)]
+        # a value stored by the version 1 of the format, without the stats
+        point = np.asarray(self.els[0], dtype=BinaryCodec.DTYPE)
+        blobs.append(BinaryCodec.HEADER.pack(BinaryCodec.MAGIC, 1, 0, 0, len(point), 0) + point.tobytes())
+        matrix, extras, stats = codec.loads_many(blobs, extras=True, stats=True)
+        self.assertEqual(extras, self.el_names + [None])
+        np.testing.assert_allclose(stats, BinaryCodec.stats(matrix))
+        np.testing.assert_allclose(codec.loads(blobs[-1]), self.els[0], rtol=1e-6)
+
+    def test_lshash_binary(self):
+        configs = [{"sqlite": {"serializer": "binary"}},
+                   {"redis": {"host": 'localhost', "port": 6379, "db": 15, "serializer": "binary"}}]
+        for config in configs:
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config)
+            for i in range(self.nb_elements):
+                lsh.index(list(self.els[i]), self.el_names[i])
+                lsh.index(list(self.els[i]), self.el_names[i])  # multiple insertions
+            hasht = lsh.hash_tables[0]
+            self.assertEqual(sum(len(hasht.get_list(k)) for k in hasht.keys()), self.nb_elements)
+            for el, name in zip(self.els, self.el_names):
+                (el_v, el_name), el_dist = lsh.query(list(el), num_results=1)[0]
+                np.testing.assert_allclose(el_v, el, rtol=1e-6)
+                self.assertEqual(el_name, name)
+                self.assertAlmostEqual(el_dist, 0)
+
+    def test_rank_from_matrix(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            configs = [{"sqlite": {"serializer": "binary"}},
+                       {"segment": {"path": tmpdir, "serializer": "binary"}},
+                       {"sharded": {"shards": [{"sqlite": {"serializer": "binary"}},
+                                               {"sqlite": {"serializer": "binary"}}],
+                                    "placement": "value"}}]
+            reference = LSHash(self.hash_size, self.input_dim, 2)
+            for el, name in zip(self.els, self.el_names):
+                reference.index(list(el), name)
+            for config in configs:
+                lsh = LSHash(self.hash_size, self.input_dim, 2, config)
+                lsh.uniform_planes = reference.uniform_planes
+                for el, name in zip(self.els, self.el_names):
+                    lsh.index(list(el), name)
+                codec = lsh._raw_codec()
+                self.assertIsInstance(codec, BinaryCodec)
+                decoded = []
+                loads = codec.loads
+                codec.loads = lambda blob: decoded.append(blob) or loads(blob)
+                try:
+                    for el in self.els:
+                        result = lsh.query(list(el), num_results=3)
+                        expected = reference.query(list(el), num_results=3)
+                        self.assertEqual([ix[1] for ix, _ in result], [ix[1] for ix, _ in expected])
+                        np.testing.assert_allclose([dist for _, dist in result],
+                                                   [dist for _, dist in expected], rtol=1e-4, atol=1e-4)
+                        self.assertEqual([ix[1] for ix, _ in lsh.query_iter(list(el), num_results=3)],
+                                         [ix[1] for ix, _ in expected])
+                finally:
+                    codec.loads = loads
+                # only the returned candidates are fully decoded, by each shard
+                # and once merged for the query, and by query_iter
+                self.assertLessEqual(len(decoded), (3 * 2 + 3 + 3) * len(self.els))
+                if "segment" in config:
+                    for hasht in lsh.hash_tables:
+                        hasht.close()
+
+    def test_tuple_extra_data(self):
+        codec = BinaryCodec()
+        for extra in [("id", 1), ["a", 2], {"k": (1, 2)}, 3.5, None, "name"]:
+            self.assertEqual(codec.loads(codec.dumps((self.els[0], extra)))[1], extra)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"sqlite": {"database": os.path.join(tmpdir, "lshash.db"), "serializer": "pickle"}}
+            matrices_filename = os.path.join(tmpdir, "planes.npz")
+            lsh = LSHash(2, self.input_dim, 1, config, matrices_filename)
+            for i, el in enumerate(self.els[:10]):
+                lsh.index(list(el), ("id", i))
+            # migrated to the binary format, then indexed in it
+            config["sqlite"]["serializer"] = "binary"
+            lsh = LSHash(2, self.input_dim, 1, config, matrices_filename)
+            lsh.hash_tables[0].migrate()
+            for i, el in enumerate(self.els[10:20], 10):
+                lsh.index(list(el), ("id", i))
+            for i, el in enumerate(self.els[:20]):
+                (el_v, el_extra), _ = lsh.query(list(el), num_results=1)[0]
+                self.assertEqual(el_extra, ("id", i))
+
+    def test_migration(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"sqlite": {"database": os.path.join(tmpdir, "lshash.db"), "serializer": "pickle"}}
+            matrices_filename = os.path.join(tmpdir, "planes.npz")
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            for i in range(self.nb_elements):
+                lsh.index(list(self.els[i]), self.el_names[i])
+            config["sqlite"]["serializer"] = "binary"
+            lsh = LSHash(self.hash_size, self.input_dim, 1, config, matrices_filename)
+            hasht = lsh.hash_tables[0]
+            before = sorted(v for k in hasht.keys() for v in hasht.get_list(k))
+            hasht.migrate()
+            raw_values = hasht.connection.execute(f"SELECT value FROM {hasht.table}").fetchall()
+            self.assertTrue(all(hasht.serializer.is_binary(value[0]) for value in raw_values))
+            after = sorted(v for k in hasht.keys() for v in hasht.get_list(k))
+            self.assertEqual([v[1] for v in before], [v[1] for v in after])
+            np.testing.assert_allclose([v[0] for v in after], [v[0] for v in before], rtol=1e-6)
+
+
+class TestStorageRegistry(TestCase):
+    nb_elements = NB_ELEMENTS
+    hash_size = HASH_SIZE
+    input_dim = INPUT_DIM
+    els = ELEMENTS
+
+    def test_lazy_imports(self):
+        code = "import sys, lshash; print(sorted({'joblib', 'redis', 'sqlite3', 'bitarray'} & set(sys.modules)))"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=root)
+        self.assertEqual(output.decode().strip(), "[]")
+
+    def test_register_storage(self):
+        class CountingStorage(InMemoryStorage):
+            appended = 0
+
+            def append_val(self, key, val):
+                CountingStorage.appended += 1
+                super().append_val(key, val)
+
+        register_storage("counting", CountingStorage)
+        lsh = LSHash(self.hash_size, self.input_dim, 2, {"counting": None})
+        for i in range(self.nb_elements):
+            lsh.index(list(self.els[i]))
+        self.assertEqual(CountingStorage.appended, 2 * self.nb_elements)
+        self.assertEqual(lsh.query(list(self.els[0]), num_results=1)[0][0], self.els[0])
+        with self.assertRaises(ValueError):
+            LSHash(self.hash_size, self.input_dim, 1, {"unknown": None})
+
+
 class TestMultilevelLSHash(TestCase):
     nb_elements = NB_ELEMENTS
     hash_size = HASH_SIZE